@@ -1,8 +1,11 @@
 from string import ascii_lowercase as letters
+import math
 import random
+import parallel
+import wordindex
 
-with open('/usr/share/dict/words') as f:
-    DICTIONARY = set(line.strip().upper() for line in f.readlines())
+# Compiled once from /usr/share/dict/words; see wordindex.py
+DICTIONARY = wordindex.load()
 
 def display(board):
     print 'Board is:'
@@ -10,6 +13,9 @@ def display(board):
         print row
     return None
 
+ORTHOGONAL_OFFSETS = ((1,0), (-1, 0), (0, 1), (0, -1))
+ALL_OFFSETS = ((1,1), (1,0), (1, -1), (0, 1), (0, -1), (-1, 1), (-1, 0), (-1, -1))
+
 def possibilities(position, BS, diagonals=True, toroidal=False):
     '''Enumerates the 8 possibilities for next position,
     excluding the starting position
@@ -17,10 +23,7 @@ def possibilities(position, BS, diagonals=True, toroidal=False):
     # unpack position 2-tuple
     i, j = position 
     # This version disallows board wraps
-    if not diagonals:
-        offsets = [(1,0), (-1, 0), (0, 1), (0, -1)]
-    else:
-        offsets = [(1,1), (1,0), (1, -1), (0, 1), (0, -1), (-1, 1), (-1, 0), (-1, -1)]
+    offsets = ALL_OFFSETS if diagonals else ORTHOGONAL_OFFSETS
 
     all_possibilities = [(i+k, j+l) for (k, l) in offsets]
     if toroidal:
@@ -28,37 +31,303 @@ def possibilities(position, BS, diagonals=True, toroidal=False):
 
     return [(i,j) for (i,j) in all_possibilities if 0<=i<BS and 0<=j<BS] 
 
+_NEIGHBOR_TABLES = {}
+
+def neighbor_table(rows, cols, diagonals=True, toroidal=False):
+    '''
+    Precomputed neighbors for a rows x cols board, built once per setting.
+    Cells are numbered i * cols + j, and entry n of the table is a tuple of
+    the cell numbers next to cell n. Unlike possibilities(), a cell that
+    several offsets wrap onto is only listed once, and never as its own
+    neighbor.
+    '''
+    key = (rows, cols, diagonals, toroidal)
+    if key not in _NEIGHBOR_TABLES:
+        offsets = ALL_OFFSETS if diagonals else ORTHOGONAL_OFFSETS
+        table = []
+        for i in range(rows):
+            for j in range(cols):
+                neighbors = []
+                for k, l in offsets:
+                    n_i, n_j = i + k, j + l
+                    if toroidal:
+                        n_i, n_j = n_i % rows, n_j % cols
+                    cell = n_i * cols + n_j
+                    if (0 <= n_i < rows and 0 <= n_j < cols
+                            and (n_i, n_j) != (i, j) and cell not in neighbors):
+                        neighbors.append(cell)
+                table.append(tuple(sorted(neighbors)))
+        _NEIGHBOR_TABLES[key] = tuple(table)
+    return _NEIGHBOR_TABLES[key]
+
+def board_shape(board):
+    ''' Returns (rows, columns) of $board, a list of equally long rows.'''
+    rows, cols = len(board), len(board[0])
+    for row in board:
+        if len(row) != cols:
+            raise ValueError('Board rows must all be %s letters long, got %r' % (cols, row))
+    return rows, cols
+
 def translate(sequence, board):
     ''' Takes a path on the board and converts it into its string representation'''
     return ''.join(board[i][j] for (i,j) in sequence)
 
 def search(board, length, **kwargs):
     ''' Searches the board for all words that are $length long.'''
-    # assume square board
-    BS = len(board)
-    board = [row.upper() for row in board]
-    # Internally a path is represented by a list of 2-tuples:
-    # [(1,1), (1,2), (1,3), (2,3)... etc]
-
-    # Possible start positions, formatted as a 1-path
-    paths = [[(i,j)] for i in range(BS) for j in range(BS)]
-
-    for i in range(length - 1):
-        # Recursively build up new possibilities, pruning at each step
-        # the paths that self-intersect.
-        paths = [path + [possibility] for path in paths for possibility in possibilities(path[-1], BS, **kwargs)]
-        # This weeds out self-intersecting paths.
-        paths = [p for p in paths if len(set(p)) == len(p)]
-
-    words = [translate(path, board) for path in paths]
-    valid_words = filter(lambda word: word in DICTIONARY, words)
-
-    # Only print unique hits
-    return set(valid_words)
-    
+    return search_range(board, length, length, **kwargs)
+
+def search_range(board, min_length, max_length=None, diagonals=True, toroidal=False):
+    ''' Searches the board for all words between $min_length and $max_length
+    letters long (inclusive), in a single pass. Boards may be rectangular.
+
+    Walks the board depth first alongside the dictionary's DAWG, so a path
+    is abandoned as soon as its letters stop being the prefix of any word.
+    Raises ValueError if the rows are not all the same length.
+    '''
+    rows, cols = board_shape(board)
+    # Cell n is letters[n]; see neighbor_table.
+    letters = ''.join(board).upper()
+    neighbors = neighbor_table(rows, cols, diagonals, toroidal)
+    if max_length is None:
+        max_length = rows * cols
+    child, is_word = DICTIONARY.child, DICTIONARY.is_word
+    found = set()
+
+    # $visited has bit n set for every cell n already on the path.
+    def walk(cell, node, prefix, visited):
+        node = child(node, letters[cell])
+        if node is None:
+            return
+        word = prefix + letters[cell]
+        if len(word) >= min_length and is_word(node):
+            found.add(word)
+        if len(word) < max_length:
+            visited |= 1 << cell
+            for n in neighbors[cell]:
+                if not visited >> n & 1:
+                    walk(n, node, word, visited)
+
+    for cell in range(rows * cols):
+        walk(cell, 0, '', 0)
+    return found
+
+class IncrementalScorer():
+    '''
+    Keeps every path on a board whose letters are the prefix of a dictionary
+    word, so that changing a single cell only redoes the part of the search
+    that passes through that cell. The score of a board is the number of
+    distinct words on it.
+
+    Internally cells are numbered as in neighbor_table and a path is a tuple
+    of cell numbers. self.prefixes maps each prefix path to its DAWG node,
+    letters and bitmask of visited cells, and self.paths maps the prefix
+    paths that spell whole words to their word. self.through and
+    self.ending_at index prefix paths by the cells they visit and the cell
+    they end on, and self.counts maps each word to how many paths spell it.
+    '''
+    def __init__(self, board, min_length=3, max_length=None, diagonals=True, toroidal=False):
+        self.rows, self.cols = board_shape(board)
+        self.board = list(''.join(board).upper())
+        self.min_length = min_length
+        self.max_length = max_length or len(self.board)
+        self.neighbors = neighbor_table(self.rows, self.cols, diagonals, toroidal)
+        self.prefixes = {}
+        self.paths = {}
+        self.through = [set() for cell in self.board]
+        self.ending_at = [set() for cell in self.board]
+        self.counts = {}
+        self.last_change = None
+        for cell in range(len(self.board)):
+            self._extend((), 0, '', 0, cell, [])
+
+    def _extend(self, path, node, prefix, visited, cell, added):
+        '''
+        Steps from the prefix path $path onto $cell and records every
+        prefix path that grows out of it, appending them to $added.
+        '''
+        node = DICTIONARY.child(node, self.board[cell])
+        if node is None:
+            return
+        word = prefix + self.board[cell]
+        path = path + (cell,)
+        visited |= 1 << cell
+        self._add(path, node, word, visited)
+        added.append(path)
+        if len(path) < self.max_length:
+            for n in self.neighbors[cell]:
+                if not visited >> n & 1:
+                    self._extend(path, node, word, visited, n, added)
+
+    def _add(self, path, node, word, visited):
+        self.prefixes[path] = (node, word, visited)
+        for cell in path:
+            self.through[cell].add(path)
+        self.ending_at[path[-1]].add(path)
+        if len(path) >= self.min_length and DICTIONARY.is_word(node):
+            self.paths[path] = word
+            self.counts[word] = self.counts.get(word, 0) + 1
+
+    def _remove(self, path):
+        node, word, visited = self.prefixes.pop(path)
+        for cell in path:
+            self.through[cell].discard(path)
+        self.ending_at[path[-1]].discard(path)
+        if path in self.paths:
+            del self.paths[path]
+            self.counts[word] -= 1
+            if not self.counts[word]:
+                del self.counts[word]
+        return node, word, visited
+
+    def score(self):
+        return len(self.counts)
+
+    def words(self):
+        return set(self.counts)
+
+    def set_letter(self, position, letter):
+        ''' Changes the cell at (row, column) $position and returns the new score.'''
+        i, j = position
+        cell = i * self.cols + j
+        removed = [(path,) + self._remove(path) for path in list(self.through[cell])]
+        old_letter = self.board[cell]
+        self.board[cell] = letter.upper()
+
+        # Every new path either starts on the changed cell or steps onto it
+        # from a surviving prefix path that ends next to it.
+        seeds = [path for n in self.neighbors[cell] for path in self.ending_at[n]
+                 if len(path) < self.max_length]
+        added = []
+        self._extend((), 0, '', 0, cell, added)
+        for path in seeds:
+            node, word, visited = self.prefixes[path]
+            self._extend(path, node, word, visited, cell, added)
+        self.last_change = (cell, old_letter, removed, added)
+        return self.score()
+
+    def undo(self):
+        ''' Reverts the last set_letter without searching the board again.'''
+        cell, old_letter, removed, added = self.last_change
+        for path in added:
+            self._remove(path)
+        for path, node, word, visited in removed:
+            self._add(path, node, word, visited)
+        self.board[cell] = old_letter
+        self.last_change = None
+        return self.score()
+
+    def display_board(self):
+        return [''.join(self.board[i * self.cols:(i + 1) * self.cols]) for i in range(self.rows)]
+
+def optimize(board, iterations, temperature=1.0, alphabet=letters.upper(), seed=None, **kwargs):
+    '''
+    Searches for a high scoring board by simulated annealing, starting from
+    $board. Each step changes one random cell to a random letter from
+    $alphabet. Improvements are always kept; a step that loses d points is
+    kept with probability exp(-d / T), where T cools linearly from
+    $temperature to zero. temperature=0 makes this plain hill climbing.
+
+    Takes the same keyword arguments as IncrementalScorer. Returns the best
+    board seen and its score.
+    '''
+    rng = random.Random(seed)
+    scorer = IncrementalScorer(board, **kwargs)
+    score = scorer.score()
+    best_board, best_score = scorer.display_board(), score
+    for step in range(iterations):
+        T = temperature * (1 - float(step) / iterations)
+        cell = rng.randrange(len(scorer.board))
+        letter = rng.choice(alphabet)
+        if letter == scorer.board[cell]:
+            continue
+        new_score = scorer.set_letter(divmod(cell, scorer.cols), letter)
+        if new_score >= score or (T > 0 and rng.random() < math.exp((new_score - score) / T)):
+            score = new_score
+            if score > best_score:
+                best_board, best_score = scorer.display_board(), score
+        else:
+            scorer.undo()
+    return best_board, best_score
+
+def read_boards(lines):
+    ''' Parses one board per line, with rows separated by whitespace:
+    "abcd efgh ijkl mnop". Blank lines are skipped.'''
+    for line in lines:
+        board = line.split()
+        if board:
+            yield board
+
+def _search_job(job):
+    board, min_length, max_length, diagonals, toroidal = job
+    try:
+        return search_range(board, min_length, max_length, diagonals, toroidal)
+    except ValueError:
+        return None
+
+def _load_dictionary():
+    # Runs once in each worker. With fork the parent's mapping is inherited;
+    # otherwise this maps the same file, so the pages are still shared.
+    wordindex.load()
+
+def search_many(boards, min_length=3, max_length=None, diagonals=True,
+                toroidal=False, processes=None, chunksize=32):
+    '''
+    Runs search_range on every board in the iterable $boards across a pool
+    of $processes workers (default: one per core), yielding the sets of
+    words in input order as they complete. A board whose rows are not all
+    the same length yields None instead of stopping the stream.
+
+    Boards are pulled from $boards lazily and only a bounded number are in
+    flight at once, so an endless stream works too.
+    '''
+    jobs = ((board, min_length, max_length, diagonals, toroidal) for board in boards)
+    return parallel.imap_bounded(_search_job, jobs, processes, chunksize,
+                                 initializer=_load_dictionary)
+
 if __name__ == '__main__':
-    BS = 7
-    board = [''.join(random.choice(letters) for i in range(BS)) for j in range(BS)]
-    display(board)
-    print search(board, 4, toroidal=False, diagonals=False)
+    import argparse
+    import sys
+    import time
 
+    parser = argparse.ArgumentParser(description='Finds dictionary words on a boggle board.')
+    parser.add_argument('--batch', metavar='FILE', nargs='?', const='-',
+                        help='Solve boards from FILE (default: stdin), one per line with rows separated by spaces. '
+                             'Prints the number of words found and the words for each board, '
+                             'or INVALID if its rows differ in length.')
+    parser.add_argument('--optimize', metavar='ITERATIONS', type=int, default=None,
+                        help='Search for the board with the most words, starting from a random board')
+    parser.add_argument('--size', type=int, default=4, help='Board size for --optimize')
+    parser.add_argument('--temperature', type=float, default=1.0,
+                        help='Starting temperature for --optimize; 0 means hill climbing')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='Worker processes for --batch (default: one per core)')
+    parser.add_argument('--min', type=int, default=3, dest='min_length', help='Shortest word to find')
+    parser.add_argument('--max', type=int, default=None, dest='max_length', help='Longest word to find')
+    parser.add_argument('--no-diagonals', action='store_false', dest='diagonals')
+    parser.add_argument('--toroidal', action='store_true')
+    args = parser.parse_args()
+
+    if args.optimize is not None:
+        board = [''.join(random.choice(letters) for i in range(args.size)) for j in range(args.size)]
+        board, score = optimize(board, args.optimize, args.temperature, min_length=args.min_length,
+                                max_length=args.max_length, diagonals=args.diagonals, toroidal=args.toroidal)
+        display(board)
+        print 'Found %s words' % score
+    elif args.batch is None:
+        BS = 7
+        board = [''.join(random.choice(letters) for i in range(BS)) for j in range(BS)]
+        display(board)
+        print search(board, 4, toroidal=False, diagonals=False)
+    else:
+        source = sys.stdin if args.batch == '-' else open(args.batch)
+        start = time.time()
+        count = 0
+        for words in search_many(read_boards(source), args.min_length, args.max_length,
+                                 args.diagonals, args.toroidal, args.processes):
+            count += 1
+            if words is None:
+                print 'INVALID'
+            else:
+                print len(words), ' '.join(sorted(words))
+        elapsed = time.time() - start
+        sys.stderr.write('Solved %s boards in %.2fs (%.0f boards/s)\n'
+                         % (count, elapsed, count / elapsed if elapsed else 0))
@@ -1,7 +1,15 @@
 from __future__ import print_function
 
+import math
+import multiprocessing
+import os
 import random
-from collections import Counter
+import time
+from collections import Counter, OrderedDict, namedtuple
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # A knock-off of the game "Threes", except instead of combining 
 # like numbers to make their double, you combine adjacent fibonacci numbers
@@ -72,15 +80,37 @@ def board_iter(board):
     'Iterates over nonempty elements of the board'
     return (item for row in board for item in row if item != EMPTY)
 
-def power_rand(p, lower, upper): 
+def power_rand(p, lower, upper, rng=random): 
     '''
     Power law distributed random numbers, flipped so that early numbers are
-    more frequent.
+    more frequent. $rng is the random module or a random.Random.
     http://mathworld.wolfram.com/RandomNumber.html
     '''
-    return ((upper**(p+1) - lower**(p+1)) * random.random() + lower**(p+1)) ** (1/(p+1))
+    return ((upper**(p+1) - lower**(p+1)) * rng.random() + lower**(p+1)) ** (1/(p+1))
 
-def get_new_fib(board):
+# Use a power law to weight the random tiles towards the smaller numbers.
+# The likelyhood of the tile F_n is proportional to n^p.
+NEW_FIB_POWER = -1.5
+
+def new_fib_max_index(highest_index):
+    '''
+    The index in FIBS of the largest new tile, given the index of the highest
+    tile on board (2 for an empty board).
+    '''
+    return max(2, highest_index - 2)
+
+def new_fib_odds(max_index, p=NEW_FIB_POWER):
+    '''
+    The exact distribution that get_new_fib draws from, as a list of
+    (index into FIBS, probability) pairs.
+    '''
+    # power_rand(p, 1, max_index + 2) lands in [n, n+1) with probability
+    # proportional to (n+1)^(p+1) - n^(p+1).
+    lower, upper = 1, max_index + 2
+    total = upper**(p+1) - lower**(p+1)
+    return [(n - 1, ((n+1)**(p+1) - n**(p+1)) / total) for n in range(lower, upper)]
+
+def get_new_fib(board, rng=random):
     '''
     Returns a random new fibonacci number. 
     If the highest number on board is 21, can return fibs up to 8.
@@ -92,17 +122,15 @@ def get_new_fib(board):
         highest_number = max(board_iter(board))
         index = FIBS.index(highest_number)
     # The largest fibonacci F_index that we are going to produce.
-    max_index = max(2, index - 2) 
+    max_index = new_fib_max_index(index)
 
-    # Use a power law to weight the random tiles towards the smaller numbers.
-    # The likelyhood of the tile F_n is proportional to n^p.
-    p = -1.5
+    p = NEW_FIB_POWER
     # offset by 1 and subtract later because power laws blow up at 0.
     lower = 1
     # we want an upper-inclusive range, so add another 1.
     upper = max_index + 2
 
-    return FIBS[int(power_rand(p, lower, upper)) - 1]
+    return FIBS[int(power_rand(p, lower, upper, rng)) - 1]
 
 def move_left(board, next_piece):
     '''
@@ -174,6 +202,579 @@ def print_score_breakdown(board):
                     ))
     print(row_template.format('', '', 'Total:', str(score_board(board))))
 
+# Bitboards.
+#
+# For search and simulation, a board can also be packed into a single int
+# with 5 bits per cell. A cell holds 0 for EMPTY or i+1 for the tile FIBS[i]
+# (its "code"), so tiles up to FIBS[30] fit. Cell (i, j) sits at bit
+# 5 * (BOARD_SIZE*i + j), so each row is a 20-bit chunk with its leftmost
+# cell in the low bits.
+#
+# Every move is a shift of each row (or column) on its own, so the results
+# of shifting any possible row left and right are tabulated once, on first
+# use. Columns are handled by transposing the board and shifting rows.
+# The bit_* functions mirror the tuple board functions above, but take
+# and return packed boards and take the next tile as a code.
+#
+# The tables and transposition are written for BOARD_SIZE 4 only.
+
+assert BOARD_SIZE == 4
+CELL_BITS = 5
+CELL_MASK = (1 << CELL_BITS) - 1
+ROW_BITS = CELL_BITS * BOARD_SIZE
+ROW_MASK = (1 << ROW_BITS) - 1
+# The codes of each tile, and the tile of each code.
+CODES = {fib: i + 1 for i, fib in enumerate(FIBS[:CELL_MASK])}
+CODES[EMPTY] = 0
+TILES = [EMPTY] + FIBS[:CELL_MASK]
+
+def to_bitboard(board):
+    ''' Packs a tuple board. Raises ValueError for tiles too big to pack.'''
+    bits = 0
+    for p, tile in enumerate(tile for row in board for tile in row):
+        if tile not in CODES:
+            raise ValueError("Can't pack %s into a bitboard" % (tile,))
+        bits |= CODES[tile] << (CELL_BITS * p)
+    return bits
+
+def from_bitboard(bits):
+    return tuple(tuple(TILES[(bits >> (CELL_BITS * (BOARD_SIZE*i + j))) & CELL_MASK]
+                       for j in range(BOARD_SIZE))
+                 for i in range(BOARD_SIZE))
+
+def _combine(a, b):
+    ''' The code of the tile made by combining tiles with codes a and b, or 0.'''
+    if a == b == 1 or (a and b and abs(a - b) == 1):
+        return max(a, b) + 1
+    return 0
+
+_TABLES = []
+
+def _row_tables():
+    '''
+    Builds (left, right, score, stuck, empty, highest) on first use: for
+    every packed row, the row shifted left, the row shifted right, its
+    score, whether it can't be shifted either way, how many of its cells
+    are empty and the code of its highest tile. A shift that would make a tile too big to
+    pack is recorded as -1.
+
+    This is leftshift unrolled for rows of 4, since it runs a million times.
+    '''
+    if not _TABLES:
+        from array import array
+        size = 1 << ROW_BITS
+        left = array('l', [0]) * size
+        right = array('l', [0]) * size
+        score = array('l', [0]) * size
+        stuck = bytearray(size)
+        empty = bytearray(size)
+        highest = bytearray(size)
+        codes = range(CELL_MASK + 1)
+        values = [0] + [2**i for i in range(CELL_MASK)]
+        # Combining into a code too big to pack gives something too big
+        # for a row, whatever it is or'ed with.
+        too_big = 1 << (ROW_BITS + CELL_BITS * BOARD_SIZE)
+        combos = [[_combine(a, b) if _combine(a, b) <= CELL_MASK else too_big for b in codes] for a in codes]
+        for c3 in codes:
+            for c2 in codes:
+                for c1 in codes:
+                    base = c1 << 5 | c2 << 10 | c3 << 15
+                    base_score = values[c1] + values[c2] + values[c3]
+                    base_empty = (not c1) + (not c2) + (not c3)
+                    base_highest = max(c1, c2, c3)
+                    for c0 in codes:
+                        row = base | c0
+                        if not c0:
+                            shifted = row >> 5
+                        elif combos[c0][c1]:
+                            shifted = combos[c0][c1] | c2 << 5 | c3 << 10
+                        elif not c1:
+                            shifted = c0 | c2 << 5 | c3 << 10
+                        elif combos[c1][c2]:
+                            shifted = c0 | combos[c1][c2] << 5 | c3 << 10
+                        elif not c2:
+                            shifted = c0 | c1 << 5 | c3 << 10
+                        elif combos[c2][c3]:
+                            shifted = c0 | c1 << 5 | combos[c2][c3] << 10
+                        else:
+                            shifted = row
+                        left[row] = shifted if shifted <= ROW_MASK else -1
+
+                        if not c3:
+                            shifted = (row << 5) & ROW_MASK
+                        elif combos[c3][c2]:
+                            shifted = combos[c3][c2] << 15 | c1 << 10 | c0 << 5
+                        elif not c2:
+                            shifted = c3 << 15 | c1 << 10 | c0 << 5
+                        elif combos[c2][c1]:
+                            shifted = c3 << 15 | combos[c2][c1] << 10 | c0 << 5
+                        elif not c1:
+                            shifted = c3 << 15 | c2 << 10 | c0 << 5
+                        elif combos[c1][c0]:
+                            shifted = c3 << 15 | c2 << 10 | combos[c1][c0] << 5
+                        else:
+                            shifted = row
+                        right[row] = shifted if shifted <= ROW_MASK else -1
+
+                        score[row] = base_score + values[c0]
+                        stuck[row] = left[row] == row == right[row]
+                        empty[row] = base_empty + (not c0)
+                        highest[row] = max(base_highest, c0)
+        _TABLES.extend([left, right, score, stuck, empty, highest])
+    return _TABLES
+
+def _cells_mask(positions):
+    return sum(CELL_MASK << (CELL_BITS * p) for p in positions)
+
+# Transposing a 4x4 board takes two delta swaps: first the top right and
+# bottom left 2x2 blocks trade places, then each block is transposed.
+_BLOCK_SWAP = (_cells_mask([2, 3, 6, 7]), 6 * CELL_BITS)
+_CELL_SWAP = (_cells_mask([1, 3, 9, 11]), 3 * CELL_BITS)
+
+def bit_transpose(bits):
+    for mask, shift in (_BLOCK_SWAP, _CELL_SWAP):
+        t = (bits ^ (bits >> shift)) & mask
+        bits ^= t ^ (t << shift)
+    return bits
+
+def _rows(bits):
+    return [(bits >> (ROW_BITS * i)) & ROW_MASK for i in range(BOARD_SIZE)]
+
+def _shift_rows(bits, table, next_code, order, slot):
+    '''
+    Shifts every row of $bits through $table. Unless nothing moved, the
+    tile $next_code goes in cell $slot of the first row, in $order, with
+    that cell empty.
+    '''
+    rows = _rows(bits)
+    moved = [table[row] for row in rows]
+    if moved == rows and bits:
+        return bits
+    if -1 in moved:
+        raise OverflowError("A tile got too big for a bitboard")
+    for i in order:
+        if not (moved[i] >> (CELL_BITS * slot)) & CELL_MASK:
+            moved[i] |= next_code << (CELL_BITS * slot)
+            break
+    return moved[0] | moved[1] << ROW_BITS | moved[2] << (2 * ROW_BITS) | moved[3] << (3 * ROW_BITS)
+
+# The order rows (or columns) are tried for the new tile, and where in it
+# the tile goes, to match the rotations in move_right, move_up and move_down.
+_FORWARD = range(BOARD_SIZE)
+_BACKWARD = range(BOARD_SIZE - 1, -1, -1)
+_FIRST, _LAST = 0, BOARD_SIZE - 1
+
+def bit_move_left(bits, next_code):
+    return _shift_rows(bits, _row_tables()[0], next_code, _FORWARD, _LAST)
+
+def bit_move_right(bits, next_code):
+    return _shift_rows(bits, _row_tables()[1], next_code, _BACKWARD, _FIRST)
+
+def bit_move_up(bits, next_code):
+    return bit_transpose(_shift_rows(bit_transpose(bits), _row_tables()[0], next_code, _BACKWARD, _LAST))
+
+def bit_move_down(bits, next_code):
+    return bit_transpose(_shift_rows(bit_transpose(bits), _row_tables()[1], next_code, _FORWARD, _FIRST))
+
+bit_move_dispatch = {'w': bit_move_up,
+                     'a': bit_move_left,
+                     'd': bit_move_right,
+                     's': bit_move_down}
+bit_move_items = sorted(bit_move_dispatch.items())
+
+def bit_is_valid(move, bits):
+    if not bits:
+        return True
+    left, right = _row_tables()[:2]
+    if move in 'ws':
+        bits = bit_transpose(bits)
+    table = left if move in 'wa' else right
+    return any(table[row] != row for row in _rows(bits))
+
+def bit_check_loss(bits):
+    if not bits:
+        return False
+    stuck = _row_tables()[3]
+    columns = bit_transpose(bits)
+    return bool(stuck[bits & ROW_MASK] and stuck[(bits >> ROW_BITS) & ROW_MASK]
+                and stuck[(bits >> (2 * ROW_BITS)) & ROW_MASK] and stuck[bits >> (3 * ROW_BITS)]
+                and stuck[columns & ROW_MASK] and stuck[(columns >> ROW_BITS) & ROW_MASK]
+                and stuck[(columns >> (2 * ROW_BITS)) & ROW_MASK] and stuck[columns >> (3 * ROW_BITS)])
+
+def bit_score_board(bits):
+    score = _row_tables()[2]
+    return (score[bits & ROW_MASK] + score[(bits >> ROW_BITS) & ROW_MASK]
+            + score[(bits >> (2 * ROW_BITS)) & ROW_MASK] + score[bits >> (3 * ROW_BITS)])
+
+def bit_highest_index(bits):
+    ''' The index in FIBS of the highest tile on a packed board, or 2 if it is empty.'''
+    highest = _row_tables()[5]
+    code = max(highest[bits & ROW_MASK], highest[(bits >> ROW_BITS) & ROW_MASK],
+               highest[(bits >> (2 * ROW_BITS)) & ROW_MASK], highest[bits >> (3 * ROW_BITS)])
+    return code - 1 if code else 2
+
+def bit_empty_count(bits):
+    empty = _row_tables()[4]
+    return (empty[bits & ROW_MASK] + empty[(bits >> ROW_BITS) & ROW_MASK]
+            + empty[(bits >> (2 * ROW_BITS)) & ROW_MASK] + empty[bits >> (3 * ROW_BITS)])
+
+_ODDS = {}
+
+def bit_new_fib_odds(bits):
+    ''' new_fib_odds for the tile after a packed board, as (code, probability) pairs.'''
+    max_index = new_fib_max_index(bit_highest_index(bits))
+    if max_index not in _ODDS:
+        _ODDS[max_index] = [(index + 1, p) for index, p in new_fib_odds(max_index)]
+    return _ODDS[max_index]
+
+_testbits = to_bitboard(((1, 2, 3, 5), (EMPTY,)*4, (8, EMPTY, EMPTY, 1), (EMPTY, EMPTY, EMPTY, 13)))
+assert from_bitboard(_testbits) == ((1, 2, 3, 5), (EMPTY,)*4, (8, EMPTY, EMPTY, 1), (EMPTY, EMPTY, EMPTY, 13))
+assert from_bitboard(bit_transpose(_testbits)) == tuple(zip(*from_bitboard(_testbits)))
+
+# Expectimax.
+#
+# The player sees the next tile before moving, so a search alternates
+# between max nodes (a packed board and the known next tile: pick the best
+# move) and chance nodes (the board after a move: average over the tile
+# that comes next, weighted by new_fib_odds). Depth counts moves.
+
+def evaluate(bits):
+    '''
+    The default estimate of a packed board's worth at the search horizon:
+    its score, plus the value of its highest tile for each empty cell,
+    since room to move is what keeps a game going.
+    '''
+    return bit_score_board(bits) + bit_empty_count(bits) * 2**bit_highest_index(bits)
+
+class _OutOfTime(Exception): pass
+
+class ExpectimaxPlayer():
+    '''
+    Plays Fibs by expectimax search, deepening one move at a time until
+    $time_limit seconds have passed (or $max_depth moves) and playing the
+    best move of the deepest search that finished.
+
+    Chance node values are kept in a transposition table keyed on the
+    packed board, holding at most $table_size entries and evicting the
+    least recently used. It is kept from move to move, since the boards
+    searched after one move mostly were searched before it too.
+
+    Call it with a tuple board and the next tile, as play_game does, to
+    get a move in 'wasd'.
+    '''
+    def __init__(self, time_limit=0.1, max_depth=8, table_size=2**17, evaluate=evaluate):
+        self.time_limit = time_limit
+        self.max_depth = max_depth
+        self.table_size = table_size
+        self.evaluate = evaluate
+        self.table = OrderedDict()
+        # The depth of the last search that finished.
+        self.depth = 0
+
+    def __call__(self, board, next_piece):
+        return self.choose_move(to_bitboard(board), CODES[next_piece])
+
+    def choose_move(self, bits, next_code):
+        ''' The best move for a packed board, or None if there are none.'''
+        deadline = time.time() + self.time_limit
+        move = self.search(bits, next_code, 1, None)[1]
+        self.depth = 1
+        for depth in range(2, self.max_depth + 1):
+            try:
+                move = self.search(bits, next_code, depth, deadline)[1]
+            except _OutOfTime:
+                break
+            self.depth = depth
+        return move
+
+    def search(self, bits, next_code, depth, deadline):
+        ''' A max node. Returns (value, best move), with no move if the game is lost.'''
+        best = (bit_score_board(bits), None)
+        for move, move_function in bit_move_items:
+            after = move_function(bits, next_code)
+            if after == bits and bits:
+                continue
+            value = self.expect(after, depth - 1, deadline)
+            if best[1] is None or value > best[0]:
+                best = (value, move)
+        return best
+
+    def expect(self, bits, depth, deadline):
+        ''' A chance node.'''
+        if depth == 0:
+            return self.evaluate(bits)
+        table = self.table
+        if bits in table:
+            stored_depth, value = table.pop(bits)
+            table[bits] = (stored_depth, value)
+            if stored_depth >= depth:
+                return value
+        if deadline is not None and time.time() > deadline:
+            raise _OutOfTime()
+        value = sum(p * self.search(bits, code, depth, deadline)[0]
+                    for code, p in bit_new_fib_odds(bits))
+        table[bits] = (depth, value)
+        if len(table) > self.table_size:
+            table.popitem(last=False)
+        return value
+
+
+# Simulation.
+#
+# simulate plays a whole batch of games at once as NumPy arrays, with each
+# batch of boards an (n, 4, 4) array of codes. Moves go through the same
+# row tables as bitboards. New tiles are drawn by looking up uniform
+# samples in a table of the tile distribution's CDF, instead of calling
+# power_rand for every tile.
+
+MOVES = 'wasd'
+_NP_TABLES = []
+_CELL_SHIFTS = CELL_BITS * np.arange(BOARD_SIZE) if np is not None else None
+
+def _np_tables():
+    ''' The left and right row tables as arrays.'''
+    if not _NP_TABLES:
+        left, right = _row_tables()[:2]
+        _NP_TABLES.extend([np.frombuffer(left, dtype='l'), np.frombuffer(right, dtype='l')])
+    return _NP_TABLES
+
+def _np_rows(cells):
+    return (cells.astype(np.int64) << _CELL_SHIFTS).sum(-1)
+
+def np_valid_moves(cells):
+    ''' Which of MOVES each board in $cells can make, as an (n, 4) array.'''
+    left, right = _np_tables()
+    rows = _np_rows(cells)
+    columns = _np_rows(cells.transpose(0, 2, 1))
+    valid = np.empty((len(cells), len(MOVES)), dtype=bool)
+    for m, move in enumerate(MOVES):
+        lines = columns if move in 'ws' else rows
+        table = left if move in 'wa' else right
+        valid[:, m] = (table[lines] != lines).any(1)
+    valid[~cells.any((1, 2))] = True
+    return valid
+
+# Where each move puts the new tile, as in _shift_rows.
+_NP_SLOTS = {'a': (list(_FORWARD), _LAST), 'd': (list(_BACKWARD), _FIRST),
+             'w': (list(_BACKWARD), _LAST), 's': (list(_FORWARD), _FIRST)}
+
+def np_move(cells, move, next_codes):
+    '''
+    Makes $move on every board in $cells, adding the tiles $next_codes.
+    The move has to be valid for all of them.
+    '''
+    left, right = _np_tables()
+    if move in 'ws':
+        cells = cells.transpose(0, 2, 1)
+    rows = _np_rows(cells)
+    moved = (left if move in 'wa' else right)[rows]
+    if (moved < 0).any():
+        raise OverflowError("A tile got too big for a bitboard")
+    order, slot = _NP_SLOTS[move]
+    shift = CELL_BITS * slot
+    open_slots = (((moved >> shift) & CELL_MASK) == 0)[:, order]
+    games = np.nonzero(open_slots.any(1))[0]
+    lines = np.asarray(order)[open_slots[games].argmax(1)]
+    moved[games, lines] |= next_codes[games].astype(np.int64) << shift
+    cells = ((moved[..., None] >> _CELL_SHIFTS) & CELL_MASK).astype(np.uint8)
+    return cells.transpose(0, 2, 1) if move in 'ws' else cells
+
+def _np_cdfs(power):
+    '''
+    cdfs[max_index, i] is the probability that the new tile has index at
+    most i in FIBS, when new_fib_max_index is max_index.
+    '''
+    cdfs = np.ones((CELL_MASK + 1, CELL_MASK))
+    for max_index in range(CELL_MASK + 1):
+        odds = new_fib_odds(max(max_index, 2), power)
+        cdfs[max_index, :len(odds)] = np.cumsum([p for index, p in odds])[:CELL_MASK]
+    return cdfs
+
+def np_new_fibs(cells, rng, cdfs):
+    ''' Draws the next tile's code for every board in $cells, like get_new_fib.'''
+    highest = cells.max((1, 2)).astype(np.intp)
+    highest_index = np.where(highest > 0, highest - 1, 2)
+    max_index = np.maximum(2, highest_index - 2)
+    u = rng.random_sample(len(cells))
+    index = (u[:, None] >= cdfs[max_index]).sum(1)
+    return (np.minimum(index, max_index) + 1).astype(np.uint8)
+
+def random_policy(cells, next_codes, valid, rng):
+    ''' Picks one of each board's valid moves at random.'''
+    return ((rng.random_sample(valid.shape) + 1) * valid).argmax(1)
+
+def corner_policy(cells, next_codes, valid, rng):
+    ''' Moves left, else down, else right, else up, to pile tiles in the bottom left.'''
+    order = [MOVES.index(move) for move in 'asdw']
+    return np.asarray(order)[valid[:, order].argmax(1)]
+
+SimulationResult = namedtuple('SimulationResult', ['games', 'mean_score', 'mean_moves',
+                                                   'score_histogram', 'max_tile_histogram'])
+
+def simulate(policy=random_policy, games=10000, seed=None, batch_size=10000,
+             power=NEW_FIB_POWER, scores=SCORES):
+    '''
+    Plays $games games of Fibs, $batch_size at a time, and sums up how they
+    ended. $policy(cells, next_codes, valid, rng) picks a move for each
+    board, as an index into MOVES; see random_policy. $power and $scores
+    replace NEW_FIB_POWER and SCORES, for tuning them.
+
+    score_histogram counts final scores by power of 2, so 512 counts scores
+    from 512 to 1023. max_tile_histogram counts games by their highest tile.
+    Requires NumPy.
+    '''
+    if np is None:
+        raise ImportError('simulate needs numpy')
+    rng = np.random.RandomState(seed)
+    cdfs = _np_cdfs(power)
+    tile_scores = np.array([0] + [scores[fib] for fib in FIBS[:CELL_MASK]], dtype=np.float64)
+    finals, max_tiles, lengths = [], [], []
+    for start in range(0, games, batch_size):
+        cells = np.zeros((min(batch_size, games - start), BOARD_SIZE, BOARD_SIZE), dtype=np.uint8)
+        moves = np.zeros(len(cells), dtype=np.int64)
+        valid = np_valid_moves(cells)
+        while len(cells):
+            next_codes = np_new_fibs(cells, rng, cdfs)
+            chosen = np.asarray(policy(cells, next_codes, valid, rng))
+            if not valid[np.arange(len(cells)), chosen].all():
+                raise ValueError('%s chose an invalid move' % policy.__name__)
+            for m, move in enumerate(MOVES):
+                games_moving = np.nonzero(chosen == m)[0]
+                if len(games_moving):
+                    cells[games_moving] = np_move(cells[games_moving], move, next_codes[games_moving])
+            moves += 1
+            valid = np_valid_moves(cells)
+            lost = ~valid.any(1)
+            finals.append(tile_scores[cells[lost]].sum((1, 2)))
+            max_tiles.append(cells[lost].max((1, 2)))
+            lengths.append(moves[lost])
+            cells, moves, valid = cells[~lost], moves[~lost], valid[~lost]
+    finals, max_tiles, lengths = np.concatenate(finals), np.concatenate(max_tiles), np.concatenate(lengths)
+    buckets = np.floor(np.log2(np.maximum(finals, 1))).astype(np.int64)
+    return SimulationResult(
+        games=games,
+        mean_score=finals.mean(),
+        mean_moves=lengths.mean(),
+        score_histogram={2**int(k): int(n) for k, n in zip(*np.unique(buckets, return_counts=True))},
+        max_tile_histogram={TILES[int(code)]: int(n) for code, n in zip(*np.unique(max_tiles, return_counts=True))})
+
+
+# Tournaments.
+#
+# A player is any callable (board, next_piece) -> move in 'wasd', like the
+# ones play_game takes. tournament plays every player on the same seeds, so
+# each seed gives every player the same stream of random numbers for tiles.
+
+def random_player(board, next_piece):
+    return random.choice([move for move in 'wasd' if is_valid(move, board)])
+
+def corner_player(board, next_piece):
+    ''' Moves left, else down, else right, else up, to pile tiles in the bottom left.'''
+    return next(move for move in 'asdw' if is_valid(move, board))
+
+def play_headless(player, seed):
+    '''
+    Plays a game of Fibs without printing anything, with tiles from
+    get_new_fib seeded with $seed. Returns (score, moves, highest tile).
+    '''
+    rng = random.Random(seed)
+    board = new_board()
+    moves = 0
+    while True:
+        next_piece = get_new_fib(board, rng)
+        board = move_dispatch[player(board, next_piece)](board, next_piece)
+        moves += 1
+        if check_loss(board):
+            return score_board(board), moves, max(board_iter(board))
+
+def _tournament_job(job):
+    name, player, seed = job
+    # Players that use the random module get a reproducible game too.
+    random.seed(seed)
+    start = time.time()
+    score, moves, highest = play_headless(player, seed)
+    return name, seed, score, moves, highest, os.getpid(), time.time() - start
+
+TournamentResult = namedtuple('TournamentResult', ['player', 'seed', 'score', 'moves', 'highest', 'worker', 'seconds'])
+
+def read_results(path):
+    '''
+    Reads a tournament results file, one game per line. A line that is not
+    a whole result, like the one left behind when a run is killed while
+    writing, is skipped; a line counts only once its newline is written.
+    '''
+    results = []
+    if not os.path.exists(path):
+        return results
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not line.endswith('\n') or len(fields) != len(TournamentResult._fields):
+                continue
+            name, seed, score, moves, highest, worker, seconds = fields
+            try:
+                results.append(TournamentResult(name, int(seed), int(score), int(moves), int(highest),
+                                                int(worker), float(seconds)))
+            except ValueError:
+                continue
+    return results
+
+def _drop_partial_line(path):
+    ''' Cuts an unfinished last line off the file at $path, so appending starts on a new line.'''
+    with open(path, 'rb+') as f:
+        contents = f.read()
+        if contents and not contents.endswith(b'\n'):
+            f.truncate(contents.rfind(b'\n') + 1)
+
+def tournament(players, seeds, path, processes=None):
+    '''
+    Plays each of $players (a dictionary {name: player}) on each of $seeds
+    across a pool of $processes workers (default: one per core). Each game
+    is appended to the file at $path as soon as it finishes. Games already
+    in the file are skipped, so an interrupted tournament picks up where it
+    left off. Returns every result in the file.
+    '''
+    for name in players:
+        if not name or len(name.split()) != 1:
+            raise ValueError('Player names must be one word, not %r' % name)
+    done = set((result.player, result.seed) for result in read_results(path))
+    jobs = [(name, players[name], seed) for seed in seeds for name in sorted(players)
+            if (name, seed) not in done]
+    if jobs:
+        if os.path.exists(path):
+            _drop_partial_line(path)
+        pool = multiprocessing.Pool(processes)
+        try:
+            with open(path, 'a') as f:
+                for result in pool.imap_unordered(_tournament_job, jobs):
+                    f.write('%s %s %s %s %s %s %.4f\n' % result)
+                    f.flush()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    return read_results(path)
+
+def summarize(results):
+    '''
+    Returns ({player: (games, mean score, half-width of a 95% confidence
+    interval for the mean)}, {worker: games per second}).
+    '''
+    scores, worker_games, worker_seconds = {}, Counter(), Counter()
+    for result in results:
+        scores.setdefault(result.player, []).append(result.score)
+        worker_games[result.worker] += 1
+        worker_seconds[result.worker] += result.seconds
+    players = {}
+    for name, values in scores.items():
+        n = len(values)
+        mean = sum(values) / float(n)
+        variance = sum((x - mean)**2 for x in values) / (n - 1) if n > 1 else 0.0
+        players[name] = (n, mean, 1.96 * math.sqrt(variance / n))
+    rates = {worker: worker_games[worker] / worker_seconds[worker] if worker_seconds[worker] else float('inf')
+             for worker in worker_games}
+    return players, rates
+
 
 # http://code.activestate.com/recipes/134892/
 class _Getch:
@@ -214,17 +815,23 @@ class _GetchWindows:
 
 getch = _Getch()
 
-def play_game():
-    ' Plays a game of Fibs. Returns False if the user quit.'
+def play_game(player=None):
+    '''
+    Plays a game of Fibs. Returns False if the user quit.
+    Moves come from the keyboard, or from $player(board, next_piece) if given.
+    '''
     board = new_board()
     while True:
         print_board(board)
         print("Score: %s" % score_board(board))
         next_piece = get_new_fib(board)
         print("Upcoming tile: %s" % next_piece)
-        print('make a move (wasd / q to quit)')
-
-        move = '?'
+        if player is not None:
+            move = player(board, next_piece)
+            print('Playing %s' % move)
+        else:
+            print('make a move (wasd / q to quit)')
+            move = '?'
         while not (move == 'q'
                    or (move in 'wasd'
                        and is_valid(move, board))):
@@ -238,6 +845,59 @@ def play_game():
             return True
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Plays Fibs.')
+    parser.add_argument('--ai', metavar='SECONDS', type=float, default=None,
+                        help='Watch the expectimax player play a game, thinking SECONDS per move')
+    parser.add_argument('--simulate', metavar='GAMES', type=int, default=None,
+                        help='Simulate GAMES games (needs numpy) and print score and highest tile histograms')
+    parser.add_argument('--policy', choices=['random', 'corner'], default='random',
+                        help='How simulated games pick moves')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for --simulate')
+    parser.add_argument('--tournament', metavar='GAMES', type=int, default=None,
+                        help='Play GAMES seeded games with each player and compare their scores')
+    parser.add_argument('--players', default='random,corner,expectimax',
+                        help='Comma separated players for --tournament, out of random, corner and expectimax')
+    parser.add_argument('--results', default='fibs_results.txt',
+                        help='File that --tournament writes results to and resumes from')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='Worker processes for --tournament (default: one per core)')
+    args = parser.parse_args()
+    if args.tournament is not None:
+        # The expectimax player searches to a fixed depth, so that results
+        # don't depend on how busy the machine is.
+        known_players = {'random': random_player, 'corner': corner_player,
+                         'expectimax': ExpectimaxPlayer(time_limit=float('inf'), max_depth=2)}
+        start = time.time()
+        results = tournament({name: known_players[name] for name in args.players.split(',')},
+                             range(args.tournament), args.results, args.processes)
+        elapsed = time.time() - start
+        players, rates = summarize(results)
+        for name in sorted(players, key=lambda name: -players[name][1]):
+            games, mean, error = players[name]
+            print('%-12s %6s games, mean score %.1f +/- %.1f' % (name, games, mean, error))
+        for worker in sorted(rates):
+            print('worker %s: %.1f games/s' % (worker, rates[worker]))
+        print('%.2fs elapsed' % elapsed)
+        raise SystemExit
+    if args.simulate is not None:
+        start = time.time()
+        result = simulate({'random': random_policy, 'corner': corner_policy}[args.policy],
+                          args.simulate, args.seed)
+        elapsed = time.time() - start
+        print('%s games in %.2fs (%.0f games/s): mean score %.1f, mean length %.1f moves'
+              % (result.games, elapsed, result.games / elapsed, result.mean_score, result.mean_moves))
+        print('Scores:')
+        for score in sorted(result.score_histogram):
+            print('%8s+ %s' % (score, result.score_histogram[score]))
+        print('Highest tiles:')
+        for tile in sorted(result.max_tile_histogram):
+            print('%8s  %s' % (tile, result.max_tile_histogram[tile]))
+        raise SystemExit
+    if args.ai is not None:
+        play_game(ExpectimaxPlayer(time_limit=args.ai))
+        raise SystemExit
+
     print("Welcome to Fibs! To play: 'squash' two adjacent Fibonacci numbers together to make the next one!")
     while True:
         success = play_game()
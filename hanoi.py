@@ -2,30 +2,307 @@ from __future__ import print_function
 
 PUZZLE_SIZE = 5
 
+# The optimal solution for moving n disks from one peg to another has a
+# closed form. Number the moves from 1; move m moves disk d, where 2^(d-1)
+# is the lowest set bit of m, so disk d has made (k + 2^(d-1)) >> d of the
+# first k moves. Each disk always moves the same way around the pegs: disks
+# with the same parity as n cycle source -> target -> spare, and the others
+# cycle source -> spare -> target. So where every disk is after any move
+# can be worked out directly, without replaying the moves before it.
+
+def _disk_cycle(n, disk, source, target):
+    spare = 3 - source - target
+    if (n - disk) % 2 == 0:
+        return (source, target, spare)
+    return (source, spare, target)
+
+def _moves_made(disk, k):
+    ''' How many of the first k moves move $disk.'''
+    return (k + (1 << (disk - 1))) >> disk
+
+def hanoi_moves(n, source=0, target=1, start=0):
+    '''
+    Yields the moves (disk, from, to) that take a tower of n disks from
+    peg $source to peg $target, skipping the first $start. Disks are
+    numbered from 1, the smallest. Runs in constant memory, so it's fine
+    to start it at move 2^63 of 64 disks.
+    '''
+    if source == target:
+        return
+    cycles = [None] + [_disk_cycle(n, disk, source, target) for disk in range(1, n + 1)]
+    # Not a range, which can't count this high on Python 2.
+    m, last = start + 1, (1 << n) - 1
+    while m <= last:
+        disk = (m & -m).bit_length()
+        made = _moves_made(disk, m - 1)
+        yield disk, cycles[disk][made % 3], cycles[disk][(made + 1) % 3]
+        m += 1
+
+def state_after(n, k, source=0, target=1):
+    '''
+    The stacks, as in HanoiPuzzle.stacks, after the first k moves of
+    moving a tower of n disks from peg $source to peg $target. O(n).
+    '''
+    stacks = [[], [], []]
+    for disk in range(n, 0, -1):
+        cycle = _disk_cycle(n, disk, source, target)
+        stacks[cycle[_moves_made(disk, k) % 3]].append(disk)
+    return stacks
+
+assert state_after(3, 0) == [[3, 2, 1], [], []]
+assert state_after(3, 7) == [[], [3, 2, 1], []]
+assert state_after(3, 3, 0, 2) == [[3], [2, 1], []]
+assert list(hanoi_moves(2, 0, 2)) == [(1, 0, 1), (2, 0, 2), (1, 1, 2)]
+
+# Arbitrary configurations.
+#
+# A configuration is given by which peg each disk is on: pegs[d-1] is the
+# peg of disk d. (The order of the disks on a peg is always the same, so
+# that's all there is to it.) For breadth-first search, a configuration is
+# also packed into one base 3 integer, sum(pegs[d-1] * 3^(d-1)).
+#
+# The shortest way between two configurations leaves alone the disks that
+# are bigger than any disk out of place. If d is the biggest one out of
+# place, d moves either once, straight to its target peg, or twice, via the
+# third peg. Everything else is the simpler problem of gathering the small
+# disks into a tower, or taking them from a tower, which has only one
+# shortest solution: see _gather_steps.
+
+def pegs_of(stacks):
+    ''' The peg of each disk in HanoiPuzzle.stacks.'''
+    pegs = [None] * sum(map(len, stacks))
+    for peg, stack in enumerate(stacks):
+        for disk in stack:
+            pegs[disk - 1] = peg
+    return pegs
+
+def stacks_of(pegs):
+    stacks = [[], [], []]
+    for disk in range(len(pegs), 0, -1):
+        stacks[pegs[disk - 1]].append(disk)
+    return stacks
+
+def encode(pegs):
+    state = 0
+    for peg in reversed(pegs):
+        state = 3 * state + peg
+    return state
+
+def decode(state, n):
+    pegs = []
+    for _ in range(n):
+        state, peg = divmod(state, 3)
+        pegs.append(peg)
+    return pegs
+
+def _gather_steps(pegs, k, peg):
+    '''
+    Plans the shortest way to gather disks 1..k from $pegs into a tower on
+    $peg. Returns (number of moves, steps), where each step (disk, from,
+    to, spare) means: move disk from -> to, then move the tower of smaller
+    disks from spare -> to. The steps run from the biggest disk down, and
+    get carried out in reverse.
+    '''
+    steps = []
+    length = 0
+    for disk in range(k, 0, -1):
+        if pegs[disk - 1] != peg:
+            spare = 3 - pegs[disk - 1] - peg
+            steps.append((disk, pegs[disk - 1], peg, spare))
+            length += 1 << (disk - 1)
+            peg = spare
+    return length, steps
+
+def _gather(steps):
+    for disk, source, target, spare in reversed(steps):
+        yield disk, source, target
+        for move in hanoi_moves(disk - 1, spare, target):
+            yield move
+
+def _scatter(steps):
+    # Gathering backwards, so that the tower ends up where the steps started.
+    for disk, source, target, spare in steps:
+        for move in hanoi_moves(disk - 1, target, spare):
+            yield move
+        yield disk, target, source
+
+def plan(start, target):
+    '''
+    Plans the shortest way from the configuration $start to $target, in
+    O(n). Returns (number of moves, generator of (disk, from, to) moves).
+    '''
+    assert len(start) == len(target)
+    disk = len(start)
+    while disk and start[disk - 1] == target[disk - 1]:
+        disk -= 1
+    if not disk:
+        return 0, iter(())
+    source, destination = start[disk - 1], target[disk - 1]
+    spare = 3 - source - destination
+    half = 1 << (disk - 1)
+
+    # Move the big disk once: the rest go to the spare peg and back out.
+    there, there_steps = _gather_steps(start, disk - 1, spare)
+    back, back_steps = _gather_steps(target, disk - 1, spare)
+    once = there + 1 + back
+    # Or twice: the rest go to the destination peg, back over to the source
+    # peg as a tower, and back out.
+    there2, there2_steps = _gather_steps(start, disk - 1, destination)
+    back2, back2_steps = _gather_steps(target, disk - 1, source)
+    twice = there2 + 1 + (half - 1) + 1 + back2
+
+    def once_moves():
+        for move in _gather(there_steps):
+            yield move
+        yield disk, source, destination
+        for move in _scatter(back_steps):
+            yield move
+
+    def twice_moves():
+        for move in _gather(there2_steps):
+            yield move
+        yield disk, source, spare
+        for move in hanoi_moves(disk - 1, destination, source):
+            yield move
+        yield disk, spare, destination
+        for move in _scatter(back2_steps):
+            yield move
+
+    if once <= twice:
+        return once, once_moves()
+    return twice, twice_moves()
+
+def bfs_distance(start, target):
+    '''
+    The length of the shortest way from $start to $target by brute force
+    breadth-first search over all 3^n packed configurations. Only for
+    checking plan on small puzzles.
+    '''
+    n = len(start)
+    goal = encode(target)
+    distance = {encode(start): 0}
+    frontier = [encode(start)]
+    while goal not in distance:
+        next_frontier = []
+        for state in frontier:
+            pegs = decode(state, n)
+            # The top disk of each peg is the smallest disk on it.
+            tops = {}
+            for disk in range(n, 0, -1):
+                tops[pegs[disk - 1]] = disk
+            for peg, disk in tops.items():
+                for other in range(3):
+                    if other != peg and tops.get(other, n + 1) > disk:
+                        moved = state + (other - peg) * 3**(disk - 1)
+                        if moved not in distance:
+                            distance[moved] = distance[state] + 1
+                            next_frontier.append(moved)
+        frontier = next_frontier
+    return distance[goal]
+
+assert plan([0, 0, 0], [1, 1, 1])[0] == 7
+assert bfs_distance([0, 0, 0], [1, 1, 1]) == 7
+
+# More than three pegs.
+#
+# The Frame-Stewart algorithm moves a tower of n disks with k pegs by
+# moving the top t disks to some other peg using all k pegs, the other n-t
+# disks to the target using the remaining k-1 pegs, then the t disks on
+# top of them using all k pegs again. The best t for each (n, k) is kept
+# in a table.
+#
+# The cost of splitting at t is convex in t, and the best t never goes
+# down as n goes up, so each entry is found by walking t up from the
+# previous one.
+
+_FRAME_STEWART = {}
+
+def frame_stewart_table(n, pegs):
+    '''
+    Returns (lengths, splits) for $pegs pegs, covering at least 0..n disks:
+    lengths[m] is the number of moves Frame-Stewart takes for m disks, and
+    splits[m] the number of disks it moves aside first.
+    '''
+    if pegs in _FRAME_STEWART and len(_FRAME_STEWART[pegs][0]) > n:
+        return _FRAME_STEWART[pegs]
+    if pegs == 3:
+        lengths = [(1 << m) - 1 for m in range(n + 1)]
+        splits = [max(m - 1, 0) for m in range(n + 1)]
+    else:
+        fewer = frame_stewart_table(n, pegs - 1)[0]
+        lengths, splits = [0], [0]
+        split = 0
+        for m in range(1, n + 1):
+            cost = lambda t: 2 * lengths[t] + fewer[m - t]
+            while split + 1 < m and cost(split + 1) <= cost(split):
+                split += 1
+            lengths.append(cost(split))
+            splits.append(split)
+    _FRAME_STEWART[pegs] = (lengths, splits)
+    return lengths, splits
+
+def frame_stewart_length(n, pegs):
+    return frame_stewart_table(n, pegs)[0][n]
+
+def frame_stewart_moves(n, source, target, pegs):
+    '''
+    Yields the moves (disk, from, to) that take a tower of n disks from peg
+    $source to peg $target with $pegs pegs, numbered from 0. The splits are
+    looked up in frame_stewart_table and the work left to do is kept on a
+    stack, so this doesn't recurse.
+    '''
+    splits = {k: frame_stewart_table(n, k)[1] for k in range(3, pegs + 1)}
+    # Each task is a move (disk, from, to) or a tower to move:
+    # (disks, offset, from, to, free pegs), where the disks are numbered
+    # from offset+1 and free pegs are the ones it may use.
+    tasks = [(n, 0, source, target, tuple(range(pegs)))]
+    while tasks:
+        task = tasks.pop()
+        if len(task) == 3:
+            yield task
+            continue
+        disks, offset, source, target, free = task
+        if not disks or source == target:
+            continue
+        if len(free) == 3:
+            names = (source, target, free[3 - free.index(source) - free.index(target)])
+            for disk, a, b in hanoi_moves(disks, 0, 1):
+                yield disk + offset, names[a], names[b]
+            continue
+        split = splits[len(free)][disks]
+        aside = next(peg for peg in free if peg != source and peg != target)
+        rest = tuple(peg for peg in free if peg != aside)
+        tasks.append((split, offset, aside, target, free))
+        tasks.append((disks - split, offset + split, source, target, rest))
+        tasks.append((split, offset, source, aside, free))
+
+assert [frame_stewart_length(n, 4) for n in range(1, 9)] == [1, 3, 5, 9, 13, 17, 25, 33]
+
 class HanoiPuzzle():
     '''
-    Has a single variable self.stacks, which is a list of three lists of
-    integers from 1...PUZZLE_SIZE representing the various pieces.
-    Each of the three lists should be descending, and each integer
+    Has a single variable self.stacks, which is a list of lists (three,
+    unless asked for more pegs) of integers from 1...PUZZLE_SIZE
+    representing the various pieces.
+    Each of the lists should be descending, and each integer
     should be in only one list.
 
-    The three stacks are given indices 0, 1, and 2.
+    The stacks are given indices 0, 1, 2, ...
     '''
-    def __init__(self, PUZZLE_SIZE, randomize=False):
+    def __init__(self, PUZZLE_SIZE, randomize=False, pegs=3):
         '''
         Initializes a Hanoi puzzle.
         Pass the kwarg randomize=True in order to initialize with a random
         valid configuration.
         '''
+        assert pegs >= 3
         self.size = PUZZLE_SIZE
+        self.stacks = [[] for i in range(pegs)]
         if randomize:
             import random
-            stack_allocation = (random.choice('012') for i in range(PUZZLE_SIZE))
-            self.stacks = [[], [], []]
-            for i, index in enumerate(stack_allocation):
-                self.stacks[int(index)].append(PUZZLE_SIZE - i)
+            for disk in range(PUZZLE_SIZE, 0, -1):
+                self.stacks[random.randrange(pegs)].append(disk)
         else:
-            self.stacks = [list(range(PUZZLE_SIZE, 0, -1)), [], [],]
+            self.stacks[0] = list(range(PUZZLE_SIZE, 0, -1))
 
     def __str__(self):
         output = ''
@@ -73,41 +350,46 @@ class HanoiPuzzle():
         If we make the assumption that top n disks are consecutive,
         we will always be able to recursively do the smaller case without
         worrying if the smaller one is possible.
+
+        With more than three pegs, this uses the other pegs too (see
+        frame_stewart_moves), so the n disks must be the smallest ones.
         '''
         assert n <= self.size
-        if index1 == index2:
-            return        
-        if n == 1:
-            self.move(index1, index2, **kwargs)
+        # hanoi_moves works out the same moves without recursing.
+        if len(self.stacks) == 3:
+            moves = hanoi_moves(n, index1, index2)
         else:
-            # the three stacks are 0, 1, 2.
-            # given any two, you can compute the third stack by saying
-            # 3 - index1 - index2.
-            self.move_n(n-1, index1, 3-index1-index2, **kwargs)
-            self.move(index1, index2, **kwargs)
-            self.move_n(n-1, 3-index1-index2, index2, **kwargs)
+            moves = frame_stewart_moves(n, index1, index2, len(self.stacks))
+        for disk, source, target in moves:
+            self.move(source, target, **kwargs)
 
     def solve_basic_hanoi(self, **kwargs):
         'Just for demonstration purposes.'
         self.move_n(self.size, 0, 1, **kwargs)       
 
-    def solve(self, **kwargs):
+    def solve(self, target=None, **kwargs):
         '''
-        Solves an arbitrary Hanoi puzzle instance.
-        Algorithm:
-        Start with the 1-disk. Move it onto the 2-disk if is exposed;
-        if the 2-disk is not exposed, then it must already be under the 1-disk.
-        Then, recursively move the completed n-stack onto the (n+1)-disk.
+        Solves an arbitrary Hanoi puzzle instance in as few moves as
+        possible, see plan. Reaches the configuration $target, given as the
+        peg of each disk, or by default gathers all the disks on the peg of
+        the largest one.
+        With more than three pegs, $target has to be a single tower, and
+        the solution isn't the shortest.
         '''
-        def find_piece(piece_size):
-            assert piece_size <= self.size
-            for i in range(3):
-                if piece_size in self.stacks[i]:
-                    return i
-
+        pegs = pegs_of(self.stacks)
+        if target is None:
+            target = [pegs[-1]] * self.size
+        if len(self.stacks) == 3:
+            for disk, source, destination in plan(pegs, target)[1]:
+                self.move(source, destination, **kwargs)
+            return
+        # With more pegs, there's no known shortest solution. Stack disk i
+        # onto disk i+1 in turn, then move the tower where it's wanted.
+        assert len(set(target)) == 1
         for i in range(1, self.size):
-            a, b = find_piece(i), find_piece(i+1)
-            self.move_n(i, a, b, **kwargs)
+            self.move_n(i, pegs[i - 1], pegs[i], **kwargs)
+            pegs[:i] = [pegs[i]] * i
+        self.move_n(self.size, pegs[-1], target[0], **kwargs)
             
 
 if __name__ == '__main__':
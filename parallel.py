@@ -0,0 +1,62 @@
+import multiprocessing
+import threading
+
+# Streams work through a multiprocessing pool, shared by the batch modes of
+# the games.
+
+def imap_bounded(func, jobs, processes=None, chunksize=1, initializer=None):
+    '''
+    Runs $func on every item of the iterable $jobs across a pool of
+    $processes workers (default: one per core), yielding the results in
+    input order as they complete. $initializer runs once in each worker.
+
+    Jobs are pulled from $jobs lazily and only a bounded number are in
+    flight at once, so an endless stream works too.
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    # The pool's feeder thread consumes its input as fast as it can. Make it
+    # wait for results to be collected once enough work is queued.
+    in_flight = threading.Semaphore(4 * processes * chunksize)
+    stopping = threading.Event()
+    def throttled():
+        for job in jobs:
+            in_flight.acquire()
+            if stopping.is_set():
+                return
+            yield job
+
+    pool = multiprocessing.Pool(processes, initializer=initializer)
+    try:
+        for result in pool.imap(func, throttled(), chunksize):
+            in_flight.release()
+            yield result
+        pool.close()
+    finally:
+        # terminate() joins the feeder thread, which may be waiting for a
+        # slot. Wake it and have it stop feeding first.
+        stopping.set()
+        in_flight.release()
+        pool.terminate()
+        pool.join()
+
+if __name__ == '__main__':
+    # Self-check: leaving early, by breaking out or through a failed job,
+    # must shut the pool down even with the feeder thread blocked.
+    import itertools
+    import sys
+    import time
+
+    start = time.time()
+    results = imap_bounded(abs, itertools.count(), processes=2, chunksize=4)
+    assert list(itertools.islice(results, 10)) == list(range(10))
+    results.close()
+
+    try:
+        for result in imap_bounded(float, itertools.chain(['x'], itertools.repeat('1')),
+                                   processes=2, chunksize=4):
+            pass
+    except ValueError:
+        pass
+    else:
+        assert False, 'a failed job should raise in the caller'
+    sys.stderr.write('Shut down cleanly in %.2fs\n' % (time.time() - start))
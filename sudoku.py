@@ -1,6 +1,10 @@
 from __future__ import print_function
 import itertools
 import copy
+import parallel
+import random
+import time
+from collections import namedtuple
 
 # An implementation based on Peter Norvig's sudoku solver.
 # 
@@ -24,6 +28,7 @@ import copy
 
 class InvalidBoardState(Exception): pass
 class MultipleSolutions(Exception): pass
+class GuessLimitReached(Exception): pass
 
 def cross(aset, bset):
     return tuple(a+b for a in aset for b in bset)
@@ -40,26 +45,122 @@ NEIGHBORHOODS = {cell: tuple(g for g in GROUPS if cell in g) for cell in CELLS}
 
 NEIGHBORS = {cell: set(itertools.chain(*neighborhood)) - {cell} for cell, neighborhood in NEIGHBORHOODS.items()}
 
+CELL_GROUPS = {cell: tuple(g for g, group in enumerate(GROUPS) if cell in group) for cell in CELLS}
+
 assert len(CELLS) == 81
 assert len(GROUPS) == 27
-print(NEIGHBORHOODS['A1'])
 assert NEIGHBORHOODS['A1'] == (('A1','A2','A3','A4','A5','A6','A7','A8','A9'),
                               ('A1','B1','C1','D1','E1','F1','G1','H1','I1'),
                               ('A1','A2','A3','B1','B2','B3','C1','C2','C3'))
 assert NEIGHBORS['B1'] == {'B2', 'B3', 'B4', 'B5', 'B6','B7','B8','B9', 'A1','C1','D1','E1','F1','G1','H1','I1', 'A1','C1','A2','B2','C2','A3','B3','C3'}
 
-def process_rawtext(text):
-    return ''.join(filter(lambda c: c in '.0123456789', text))
+# Values for boards of any size, in order; a board of size n uses the first n.
+SYMBOLS = '123456789ABCDEFGHIJKLMNOP'
+
+class Geometry:
+    '''
+    Integer lookup tables for a board made of box_size x box_size boxes,
+    i.e. size x size cells with size = box_size**2. Cell i is row
+    i // size, column i % size. Built once per box size; see geometry().
+
+    A cell's candidates are a bitmask: bit k is set if symbols[k] is possible.
+    '''
+    def __init__(self, box_size):
+        n = self.box_size = box_size
+        size = self.size = n * n
+        self.n_cells = size * size
+        self.symbols = SYMBOLS[:size]
+        self.all_values = (1 << size) - 1
+        rows = [[r * size + c for c in range(size)] for r in range(size)]
+        columns = [[r * size + c for r in range(size)] for c in range(size)]
+        boxes = [[(br * n + r) * size + bc * n + c for r in range(n) for c in range(n)]
+                 for br in range(n) for bc in range(n)]
+        self.units = tuple(tuple(unit) for unit in rows + columns + boxes)
+        self.cell_units = tuple(tuple(u for u, unit in enumerate(self.units) if i in unit)
+                                for i in range(self.n_cells))
+        self.peers = tuple(tuple(sorted(set(c for u in self.cell_units[i] for c in self.units[u]) - {i}))
+                           for i in range(self.n_cells))
+        if size <= 16:
+            self.bit_count = tuple(bin(mask).count('1') for mask in range(self.all_values + 1)).__getitem__
+        else:
+            self.bit_count = lambda mask: bin(mask).count('1')
+
+    def mask_values(self, mask):
+        return ''.join(v for k, v in enumerate(self.symbols) if mask >> k & 1)
+
+_GEOMETRIES = {}
+
+def geometry(box_size=3):
+    if box_size not in _GEOMETRIES:
+        _GEOMETRIES[box_size] = Geometry(box_size)
+    return _GEOMETRIES[box_size]
+
+# The integer tables agree with the cell-name ones. CELLS is sorted, so
+# cell i is CELLS[i].
+CELL_INDEX = {cell: i for i, cell in enumerate(CELLS)}
+NINE = geometry(3)
+assert NINE.symbols == NUMS
+assert NINE.units == tuple(tuple(CELL_INDEX[c] for c in group) for group in GROUPS)
+assert NINE.units[NINE.cell_units[9][2]] == tuple(CELL_INDEX[c] for c in NEIGHBORHOODS['B1'][2])
+assert set(NINE.peers[9]) == set(CELL_INDEX[c] for c in NEIGHBORS['B1'])
+assert NINE.mask_values(0b100000101) == '139'
+assert len(geometry(4).peers[0]) == 15 + 15 + 9
+
+def process_rawtext(text, box_size=3):
+    allowed = '.0' + geometry(box_size).symbols
+    return ''.join(filter(lambda c: c in allowed, text.upper()))
+
+# Deductions SudokuBoard can apply beyond single candidates and single places.
+RULES = {
+    'naked_pairs': lambda board: board.naked_subsets(2),
+    'naked_triples': lambda board: board.naked_subsets(3),
+    'hidden_pairs': lambda board: board.hidden_subsets(2),
+    'hidden_triples': lambda board: board.hidden_subsets(3),
+    'intersections': lambda board: board.intersections(),
+}
+
+def format_grid(values, box_size=3):
+    ''' Lays out a board given as a list of strings, one per cell, in a grid.'''
+    size = box_size * box_size
+    cell_width = max(len(v) for v in values) + 1
+    row_divider = '+'.join('-'*(cell_width*box_size) for i in range(box_size))
+    output = ''
+    for r in range(size):
+        output += ''.join(values[r*size+c].center(cell_width)
+                          + ('|' if c % box_size == box_size - 1 and c < size - 1 else '')
+                          for c in range(size)) + '\n'
+        if r % box_size == box_size - 1 and r < size - 1:
+            output += row_divider + '\n'
+    return output
+
+def format_board(board):
+    ''' Lays out a board given as a dictionary {cell: string} in a grid.'''
+    return format_grid([board[cell] for cell in CELLS])
 
 class SudokuBoard:
-    def __init__(self, board, debug=False):
+    '''
+    Besides the board itself, self.counts tracks how many cells of each
+    group could still hold each value, keyed by (index into GROUPS, value),
+    so that a value down to its last place in a group is spotted without
+    scanning the group.
+
+    $rules picks extra deductions from RULES that full_solve applies before
+    each guess; they cut down on guessing for hard puzzles.
+
+    This class keeps no statistics and does no tracing, so that assign and
+    eliminate stay as lean as possible; see InstrumentedSudokuBoard.
+    '''
+    def __init__(self, board, rules=(), counts=None):
         self.board = board
-        self.call_count = 0
-        self.debug = debug
         self.guess_count = 0
+        self.rules = tuple(rules)
+        if counts is None:
+            counts = {(g, value): sum(value in board[c] for c in group)
+                      for g, group in enumerate(GROUPS) for value in NUMS}
+        self.counts = counts
 
     @classmethod
-    def init_from_text(self, processed_text, debug=False):
+    def init_from_text(cls, processed_text, **kwargs):
         assert len(processed_text) == 81
         board = {}
         for i, char in enumerate(processed_text):
@@ -67,24 +168,17 @@ class SudokuBoard:
             if char in '.0':
                 board[cell] = NUMS
             else:
+                assert char in NUMS
                 board[cell] = char
-        return SudokuBoard(board, debug=debug)
+        return cls(board, **kwargs)
 
     def __copy__(self):
-        return SudokuBoard(self.board.copy())
+        return SudokuBoard(self.board.copy(), rules=self.rules, counts=self.counts.copy())
 
     def __str__(self):
-        cell_width = max(len(v) for v in self.board.values()) + 1
-        row_divider = '+'.join('-'*(cell_width*3) for i in range(3))
-        output = ''
-        for r in ROWS:
-            output += ''.join(self.board[r+c].center(cell_width)+('|' if c in '36' else '') for c in COLUMNS) + '\n'
-            if r in 'CF': 
-                output += row_divider + '\n'
-        return output
+        return format_board(self.board)
 
     def simplify(self):
-        self.call_count = 0
         try:
             for cell, values in self.board.items():
                 if len(values) == 1:
@@ -92,12 +186,20 @@ class SudokuBoard:
         except InvalidBoardState:
             print('Simplification failed...')
             print(self)
-        print("Called assign or eliminate %s times." % self.call_count)
 
-    def full_solve(self, debug=False):
+    def apply_rules(self):
+        ''' Applies self.rules over and over until none of them makes progress.'''
+        progress = bool(self.rules)
+        while progress and not self.is_solved():
+            progress = False
+            for rule in self.rules:
+                if RULES[rule](self):
+                    progress = True
+
+    def full_solve(self):
+        self.apply_rules()
         if self.is_solved():
             return 
-
         self.guess_count += 1
         unsolved_cells = filter(lambda c: len(self.board[c]) > 1, CELLS)
         shortest_cell = sorted(unsolved_cells, key=lambda c: len(self.board[c]))[0]
@@ -107,21 +209,16 @@ class SudokuBoard:
         # over onto the original board.
         valid_possibilities = []
         for possibility in self.board[shortest_cell]:
-            if debug: print("Attempting to assign %s to %s" % (possibility, shortest_cell))
             clone = copy.copy(self)
             try: 
-                clone.assign(shortest_cell, possibility)
-                clone.full_solve(debug=debug)
+                clone.guess(shortest_cell, possibility)
+                clone.full_solve()
                 # If we've gotten to this point, the guess worked.
                 valid_possibilities.append(clone)
             except InvalidBoardState, e:
-                if debug:
-                    print(e)
-                    print("Assigning %s to %s led to a contradiction" % (possibility, shortest_cell))
+                clone.backtrack(shortest_cell, possibility, e)
             except MultipleSolutions, e:
-                if debug:
-                    print(e)
-                    print("Found multiple solutions")
+                clone.backtrack(shortest_cell, possibility, e)
             self.guess_count += clone.guess_count
 
         # At this point, un-clone the board to transfer the successful assignment.
@@ -142,57 +239,936 @@ class SudokuBoard:
         else:
             # Yay, we found a unique solution.
             self.board = valid_possibilities[0].board
-        print("Made %s guessed assignments before finding the answer" % self.guess_count)
 
     def is_solved(self):
         return all(len(self.board[cell]) == 1 for cell in CELLS)
 
+    def guess(self, cell, value):
+        ''' Makes a guessed assignment on a clone, for full_solve.'''
+        self.assign(cell, value)
+
+    def backtrack(self, cell, value, error):
+        ''' Called on a clone whose guess led to $error, for full_solve.'''
+        pass
+
     def assign(self, cell, value):
-        assert value in NUMS
-        assert cell in CELLS
-        self.call_count += 1
-        if self.debug: print("assigning %s to %s." % (value, cell))
         # if value not in cell possibilities, something's wrong.
         if value not in self.board[cell]:
             raise InvalidBoardState("Attempted to assign value %s to a cell which only had possible values %s" % (cell, str(self.board[cell])))
 
         # assign, then eliminate this value from all neighbors
+        dropped = self.board[cell].replace(value, '')
         self.board[cell] = value
+        for other in dropped:
+            self.uncount(cell, other)
         for c in NEIGHBORS[cell]:
             self.eliminate(c, value, cell)
+        for other in dropped:
+            self.check_places(cell, other)
 
     def eliminate(self, cell, value, last_assigned):
-        assert value in NUMS
-        assert cell in CELLS
         if value in self.board[cell]:
-            if self.debug: print("eliminating %s from %s as a result of assigning %s." % (value, cell, last_assigned))
-            self.call_count += 1
             self.board[cell] = self.board[cell].replace(value, '')
+            self.uncount(cell, value)
             if len(self.board[cell]) == 0:
                 raise InvalidBoardState("Uhoh - we somehow eliminated the last possible value from a cell")
             # We just figured out a square. Propagate its value.
             if len(self.board[cell]) == 1:
                 self.assign(cell, self.board[cell])
+            self.check_places(cell, value)
+
+    def uncount(self, cell, value):
+        '''
+        Updates self.counts now that $value is no longer possible in $cell.
+        This must happen before anything else looks at the board, or the
+        counts and the board fall out of step.
+        '''
+        for g in CELL_GROUPS[cell]:
+            self.counts[g, value] -= 1
+
+    def check_places(self, cell, value):
+        '''
+        Checks if, in any group of $cell, we are out of places for $value or
+        deduced the only possible place for it.
+        '''
+        for g in CELL_GROUPS[cell]:
+            remaining = self.counts[g, value]
+            if remaining == 0:
+                raise InvalidBoardState("Uhoh, there are no more possible locations for %s in the neighborhood %s" % (value, GROUPS[g]))
+            elif remaining == 1:
+                place = next(c for c in GROUPS[g] if value in self.board[c])
+                if self.board[place] != value:
+                    self.assign(place, value)
+
+    # Extra deductions for apply_rules. Each returns True if it eliminated
+    # anything.
+
+    def eliminate_all(self, cells, values, reason):
+        eliminated = False
+        for c in cells:
+            for value in values:
+                if value in self.board[c]:
+                    self.eliminate(c, value, reason)
+                    eliminated = True
+        return eliminated
+
+    def naked_subsets(self, n):
+        '''
+        If n cells of a group only have n values between them, those values
+        can't go anywhere else in the group.
+        '''
+        eliminated = False
+        for group in GROUPS:
+            candidates = [c for c in group if 1 < len(self.board[c]) <= n]
+            for subset in itertools.combinations(candidates, n):
+                values = set(itertools.chain(*(self.board[c] for c in subset)))
+                if len(values) == n:
+                    others = [c for c in group if c not in subset]
+                    eliminated |= self.eliminate_all(others, values, 'naked subset %s' % (subset,))
+        return eliminated
+
+    def hidden_subsets(self, n):
+        '''
+        If n values of a group only fit in n cells between them, those cells
+        can't hold anything else.
+        '''
+        eliminated = False
+        for g, group in enumerate(GROUPS):
+            unsolved = [v for v in NUMS if self.counts[g, v] > 1]
+            for values in itertools.combinations(unsolved, n):
+                cells = [c for c in group if any(v in self.board[c] for v in values)]
+                if len(cells) == n:
+                    others = [v for v in NUMS if v not in values]
+                    eliminated |= self.eliminate_all(cells, others, 'hidden subset %s' % ''.join(values))
+        return eliminated
+
+    def intersections(self):
+        '''
+        Pointing pairs: if a value's places in a box all lie in one row or
+        column, it can't go anywhere else in that row or column.
+        Box-line reduction: if a value's places in a row or column all lie
+        in one box, it can't go anywhere else in that box.
+        '''
+        eliminated = False
+        for g, group in enumerate(GROUPS):
+            for value in NUMS:
+                places = [c for c in group if value in self.board[c]]
+                if len(places) < 2:
+                    continue
+                shared = set(CELL_GROUPS[places[0]]).intersection(*(CELL_GROUPS[c] for c in places[1:]))
+                for other in shared - {g}:
+                    others = [c for c in GROUPS[other] if c not in group]
+                    eliminated |= self.eliminate_all(others, value, 'intersection of %s' % (places,))
+        return eliminated
+
+class SolveStats(object):
+    '''
+    What an InstrumentedSudokuBoard or InstrumentedSudokuBitBoard did:
+    assignments and eliminations made (guesses included), guesses, guesses
+    that were backtracked, the deepest guess, and seconds spent in each
+    phase. The 'search' phase includes the time spent applying rules
+    between guesses, which is also counted under 'rules'.
+    '''
+    FIELDS = ('assignments', 'eliminations', 'guesses', 'backtracks', 'max_depth')
+
+    def __init__(self):
+        self.assignments = 0
+        self.eliminations = 0
+        self.guesses = 0
+        self.backtracks = 0
+        self.max_depth = 0
+        self.phase_times = {}
+
+    def add_time(self, phase, seconds):
+        self.phase_times[phase] = self.phase_times.get(phase, 0.0) + seconds
+
+    def add(self, other):
+        ''' Folds the SolveStats $other into these, e.g. to total a batch.'''
+        self.assignments += other.assignments
+        self.eliminations += other.eliminations
+        self.guesses += other.guesses
+        self.backtracks += other.backtracks
+        self.max_depth = max(self.max_depth, other.max_depth)
+        for phase, seconds in other.phase_times.items():
+            self.add_time(phase, seconds)
+
+    def as_dict(self):
+        stats = {field: getattr(self, field) for field in self.FIELDS}
+        stats['phase_times'] = dict(self.phase_times)
+        return stats
+
+    def __str__(self):
+        return ', '.join(['%s=%s' % (field, getattr(self, field)) for field in self.FIELDS]
+                         + ['%s=%.4fs' % item for item in sorted(self.phase_times.items())])
+
+def print_event(event, *details):
+    ''' A listener for InstrumentedSudokuBoard and InstrumentedSudokuBitBoard that traces every step.'''
+    if event == 'assign':
+        print("assigning %s to %s." % details[::-1])
+    elif event == 'eliminate':
+        if details[2] is None:
+            print("eliminating %s from %s." % (details[1], details[0]))
+        else:
+            print("eliminating %s from %s as a result of %s." % (details[1], details[0], details[2]))
+    elif event == 'guess':
+        print("Attempting to assign %s to %s (depth %s)" % (details[1], details[0], details[2]))
+    elif event == 'backtrack':
+        print(details[2])
+        print("Assigning %s to %s was a dead end" % (details[1], details[0]))
+
+class InstrumentedSudokuBoard(SudokuBoard):
+    '''
+    A SudokuBoard that records what it does into $stats, a SolveStats shared
+    with all of its clones, and reports each step to $listener if given:
 
-            # Also check if we deduced the only possible location in a group
-            # for the value we just eliminated
-            for neighborhood in NEIGHBORHOODS[cell]:
-                if self.debug: print("Testing %s neighborhood to check value %s" %(str(neighborhood), value))
-                possible_cells = filter(lambda c: value in self.board[c], neighborhood)
-                if self.debug: print("Narrowed down to %s" % str(possible_cells))
-                if len(possible_cells) == 0:
-                    raise InvalidBoardState("Uhoh, there are no more possible locations for %s in the neighborhood %s" % (value, neighborhood))
-                elif len(possible_cells) == 1 and possible_cells[0] != last_assigned:
-                    self.assign(possible_cells[0], value)
+        listener('assign', cell, value)
+        listener('eliminate', cell, value, cause)
+        listener('guess', cell, value, depth)
+        listener('backtrack', cell, value, error)
+
+    Use it only when the numbers are wanted; SudokuBoard pays nothing for
+    this.
+    '''
+    def __init__(self, board, rules=(), counts=None, stats=None, listener=None, depth=0):
+        SudokuBoard.__init__(self, board, rules=rules, counts=counts)
+        self.stats = SolveStats() if stats is None else stats
+        self.listener = listener
+        self.depth = depth
+
+    def __copy__(self):
+        return InstrumentedSudokuBoard(self.board.copy(), rules=self.rules, counts=self.counts.copy(),
+                                       stats=self.stats, listener=self.listener, depth=self.depth + 1)
+
+    def simplify(self):
+        start = time.time()
+        SudokuBoard.simplify(self)
+        self.stats.add_time('simplify', time.time() - start)
+
+    def apply_rules(self):
+        start = time.time()
+        SudokuBoard.apply_rules(self)
+        self.stats.add_time('rules', time.time() - start)
+
+    def full_solve(self):
+        if self.depth:
+            return SudokuBoard.full_solve(self)
+        start = time.time()
+        try:
+            SudokuBoard.full_solve(self)
+        finally:
+            self.stats.add_time('search', time.time() - start)
+
+    def guess(self, cell, value):
+        self.stats.guesses += 1
+        self.stats.max_depth = max(self.stats.max_depth, self.depth)
+        if self.listener: self.listener('guess', cell, value, self.depth)
+        SudokuBoard.guess(self, cell, value)
+
+    def backtrack(self, cell, value, error):
+        self.stats.backtracks += 1
+        if self.listener: self.listener('backtrack', cell, value, error)
+
+    def assign(self, cell, value):
+        self.stats.assignments += 1
+        if self.listener: self.listener('assign', cell, value)
+        SudokuBoard.assign(self, cell, value)
+
+    def eliminate(self, cell, value, last_assigned):
+        if value in self.board[cell]:
+            self.stats.eliminations += 1
+            if self.listener: self.listener('eliminate', cell, value, last_assigned)
+        SudokuBoard.eliminate(self, cell, value, last_assigned)
+
+class SudokuBitBoard:
+    '''
+    A compact board with the same interface as SudokuBoard, for any box
+    size (3 for the usual 9x9 board, 4 for 16x16, 5 for 25x25).
+
+    self.cells is a list of candidate bitmasks, one per cell, as described
+    in Geometry. Every change to it is logged in self.trail as
+    (cell, previous mask), so full_solve backtracks by undoing the trail
+    back to a mark instead of copying the board for every guess.
+
+    Like SudokuBoard, this class keeps no statistics; see
+    InstrumentedSudokuBitBoard, and LimitedSudokuBitBoard for a cap on
+    guessing.
+    '''
+    def __init__(self, cells, box_size=3):
+        self.cells = cells
+        self.geometry = geometry(box_size)
+        self.trail = []
+
+    @classmethod
+    def init_from_text(cls, processed_text, box_size=3, **kwargs):
+        g = geometry(box_size)
+        assert len(processed_text) == g.n_cells
+        return cls([g.all_values if char in '.0' else 1 << g.symbols.index(char)
+                    for char in processed_text], box_size, **kwargs)
+
+    def __str__(self):
+        return format_grid([self.geometry.mask_values(mask) for mask in self.cells], self.geometry.box_size)
+
+    def to_text(self):
+        ''' The board as one character per cell, with '.' for unsolved cells.'''
+        return ''.join(self.geometry.mask_values(mask) if mask and not mask & (mask - 1) else '.'
+                       for mask in self.cells)
+
+    def simplify(self):
+        ''' Propagates every solved cell. Raises InvalidBoardState on a contradiction.'''
+        for i, mask in enumerate(self.cells):
+            if mask and not mask & (mask - 1):
+                for peer in self.geometry.peers[i]:
+                    self.eliminate(peer, mask)
+
+    def is_solved(self):
+        return all(mask and not mask & (mask - 1) for mask in self.cells)
+
+    def undo(self, mark):
+        ''' Reverts every change made since the trail was $mark entries long.'''
+        cells, trail = self.cells, self.trail
+        while len(trail) > mark:
+            i, mask = trail.pop()
+            cells[i] = mask
+
+    def assign(self, i, bit):
+        if not self.cells[i] & bit:
+            raise InvalidBoardState("Attempted to assign value %s to a cell which only had possible values %s"
+                                    % (self.geometry.mask_values(bit), self.geometry.mask_values(self.cells[i])))
+        self.eliminate(i, self.cells[i] & ~bit)
+
+    # _search makes each of its guesses through this hook.
+    guess = assign
+
+    def eliminate(self, i, bits):
+        '''
+        Removes the candidates in $bits from cell $i and propagates the
+        consequences: a cell down to one candidate is removed from its
+        peers, and a value left with one place in a unit is assigned there.
+        '''
+        cells, trail = self.cells, self.trail
+        peers, units, cell_units = self.geometry.peers, self.geometry.units, self.geometry.cell_units
+        pending = [(i, bits)]
+        while pending:
+            i, bits = pending.pop()
+            mask = cells[i]
+            removed = mask & bits
+            if not removed:
+                continue
+            trail.append((i, mask))
+            mask &= ~bits
+            cells[i] = mask
+            if not mask:
+                raise InvalidBoardState("Uhoh - we somehow eliminated the last possible value from a cell")
+            if not mask & (mask - 1):
+                pending.extend((peer, mask) for peer in peers[i] if cells[peer] & mask)
+
+            while removed:
+                bit = removed & -removed
+                removed ^= bit
+                for unit in cell_units[i]:
+                    # Look for the only place left for this value, if any.
+                    place = None
+                    for c in units[unit]:
+                        if cells[c] & bit:
+                            if place is not None:
+                                break
+                            place = c
+                    else:
+                        if place is None:
+                            raise InvalidBoardState("Uhoh, there are no more possible locations for %s in a unit"
+                                                    % self.geometry.mask_values(bit))
+                        if cells[place] != bit:
+                            pending.append((place, cells[place] & ~bit))
+
+    def full_solve(self):
+        '''
+        Solves the board by depth-first search, trying the candidates of the
+        cell with the fewest first. Raises InvalidBoardState if there is no
+        solution, and MultipleSolutions as soon as a second one turns up.
+        The board is left as it was if the search is cut short.
+        '''
+        solutions = []
+        mark = len(self.trail)
+        try:
+            self._search(solutions, 2)
+        except InvalidBoardState:
+            pass
+        finally:
+            self.undo(mark)
+        if not solutions:
+            raise InvalidBoardState("Uhoh - we bruteforced and found that no possibilities worked!")
+        elif len(solutions) > 1:
+            raise MultipleSolutions('\n'.join(str(SudokuBitBoard(cells, self.geometry.box_size))
+                                              for cells in solutions))
+        self.cells[:] = solutions[0]
+
+    def _search(self, solutions, limit, rng=None):
+        '''
+        Appends solutions to $solutions, stopping once it has $limit.
+        Candidates are tried lowest first, or in random order given a
+        random.Random as $rng.
+        '''
+        cells = self.cells
+        bit_count = self.geometry.bit_count
+        best, best_count = None, self.geometry.size + 1
+        for i, mask in enumerate(cells):
+            if mask & (mask - 1):
+                count = bit_count(mask)
+                if count < best_count:
+                    best, best_count = i, count
+                    if count == 2:
+                        break
+        if best is None:
+            solutions.append(list(cells))
+            return
+
+        mask = cells[best]
+        candidates = [1 << k for k in range(self.geometry.size) if mask >> k & 1]
+        if rng is not None:
+            rng.shuffle(candidates)
+        for bit in candidates:
+            mark = len(self.trail)
+            try:
+                self.guess(best, bit)
+                self._search(solutions, limit, rng)
+            except InvalidBoardState:
+                pass
+            self.undo(mark)
+            if len(solutions) >= limit:
+                return
+
+class LimitedSudokuBitBoard(SudokuBitBoard):
+    '''
+    A SudokuBitBoard that gives up with GuessLimitReached instead of making
+    more than $max_guesses guesses (None for no limit) over its lifetime.
+    '''
+    def __init__(self, cells, box_size=3, max_guesses=None):
+        SudokuBitBoard.__init__(self, cells, box_size)
+        self.guesses_left = max_guesses
+
+    def guess(self, i, bit):
+        self._spend_guess()
+        SudokuBitBoard.guess(self, i, bit)
+
+    def _spend_guess(self):
+        if self.guesses_left is not None:
+            if not self.guesses_left:
+                raise GuessLimitReached()
+            self.guesses_left -= 1
+
+class InstrumentedSudokuBitBoard(LimitedSudokuBitBoard):
+    '''
+    A LimitedSudokuBitBoard that records what it does into $stats, a
+    SolveStats, and reports each step to $listener if given, as
+    InstrumentedSudokuBoard does. Cells are given by index and values as
+    symbols:
+
+        listener('assign', cell, value)
+        listener('eliminate', cell, values, None)
+        listener('guess', cell, value, depth)
+        listener('backtrack', cell, value, error)
+
+    Propagation runs off a work list, so eliminations have no single cause
+    to report. Steps are read back off the trail after each propagation,
+    so SudokuBitBoard's inner loop is the same for both classes.
+    '''
+    def __init__(self, cells, box_size=3, max_guesses=None, stats=None, listener=None):
+        LimitedSudokuBitBoard.__init__(self, cells, box_size, max_guesses)
+        self.stats = SolveStats() if stats is None else stats
+        self.listener = listener
+        # The guesses leading to the position being searched.
+        self.path = []
+
+    def simplify(self):
+        start = time.time()
+        try:
+            SudokuBitBoard.simplify(self)
+        finally:
+            self.stats.add_time('simplify', time.time() - start)
+
+    def full_solve(self):
+        start = time.time()
+        del self.path[:]
+        try:
+            SudokuBitBoard.full_solve(self)
+        finally:
+            self.stats.add_time('search', time.time() - start)
+
+    def eliminate(self, i, bits):
+        mark = len(self.trail)
+        try:
+            SudokuBitBoard.eliminate(self, i, bits)
+        finally:
+            self._record(mark)
+
+    def _record(self, mark):
+        ''' Counts and reports the changes logged since the trail was $mark long.'''
+        cells, stats, listener = self.cells, self.stats, self.listener
+        # Each change's new mask is the next change's old one, or the
+        # current mask for the last change to a cell.
+        steps = []
+        after = {}
+        for i, before in reversed(self.trail[mark:]):
+            steps.append((i, before, after.get(i, cells[i])))
+            after[i] = before
+        values = self.geometry.mask_values
+        for i, before, mask in reversed(steps):
+            stats.eliminations += 1
+            if listener: listener('eliminate', i, values(before & ~mask), None)
+            if mask and not mask & (mask - 1):
+                stats.assignments += 1
+                if listener: listener('assign', i, values(mask))
+
+    def guess(self, i, bit):
+        self._spend_guess()
+        self.path.append((i, bit))
+        self.stats.guesses += 1
+        self.stats.max_depth = max(self.stats.max_depth, len(self.path))
+        if self.listener: self.listener('guess', i, self.geometry.mask_values(bit), len(self.path))
+        try:
+            SudokuBitBoard.guess(self, i, bit)
+        except InvalidBoardState as e:
+            self._backtrack(e)
+            raise
+
+    def _search(self, solutions, limit, rng=None):
+        found = len(solutions)
+        SudokuBitBoard._search(self, solutions, limit, rng)
+        # Every search below the top one follows a guess.
+        if self.path:
+            if len(solutions) == found:
+                self._backtrack(InvalidBoardState('No candidate worked after this guess'))
+            else:
+                self.path.pop()
+
+    def _backtrack(self, error):
+        i, bit = self.path.pop()
+        self.stats.backtracks += 1
+        if self.listener: self.listener('backtrack', i, self.geometry.mask_values(bit), error)
+
+class DancingLinks:
+    '''
+    Knuth's Algorithm X for exact cover, using dancing links.
+
+    The matrix is a set of circular doubly linked lists threaded through
+    flat arrays: node n has neighbors L[n]/R[n] in its row and U[n]/D[n] in
+    its column, and belongs to column header C[n]. Node 0 is the root,
+    nodes 1..n_columns are the column headers, and S[c] counts the nodes
+    left in column c. Columns are numbered from 1; rows from 0, in the
+    order they were given.
+    '''
+    def __init__(self, n_columns, rows):
+        headers = range(n_columns + 1)
+        self.L = [c - 1 for c in headers]
+        self.R = [c + 1 for c in headers]
+        self.L[0], self.R[n_columns] = n_columns, 0
+        self.U = list(headers)
+        self.D = list(headers)
+        self.C = list(headers)
+        self.S = [0] * (n_columns + 1)
+        self.row_of = [None] * (n_columns + 1)
+        self.row_nodes = []
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        for row, columns in enumerate(rows):
+            first = len(C)
+            for k, c in enumerate(columns):
+                n = len(C)
+                C.append(c)
+                self.row_of.append(row)
+                U.append(U[c])
+                D.append(c)
+                D[U[c]] = n
+                U[c] = n
+                S[c] += 1
+                L.append(n - 1 if k else first + len(columns) - 1)
+                R.append(n + 1 if k < len(columns) - 1 else first)
+            self.row_nodes.append(first)
+        self.covered = set()
+
+    def cover(self, c):
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        self.covered.add(c)
+        R[L[c]], L[R[c]] = R[c], L[c]
+        i = D[c]
+        while i != c:
+            j = R[i]
+            while j != i:
+                D[U[j]], U[D[j]] = D[j], U[j]
+                S[C[j]] -= 1
+                j = R[j]
+            i = D[i]
+
+    def uncover(self, c):
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        i = U[c]
+        while i != c:
+            j = L[i]
+            while j != i:
+                S[C[j]] += 1
+                D[U[j]] = U[D[j]] = j
+                j = L[j]
+            i = U[i]
+        R[L[c]] = L[R[c]] = c
+        self.covered.discard(c)
+
+    def select(self, row):
+        '''
+        Puts $row in the solution up front by covering all of its columns.
+        Raises InvalidBoardState if one of them is already covered.
+        '''
+        first = self.row_nodes[row]
+        j = first
+        while True:
+            if self.C[j] in self.covered:
+                raise InvalidBoardState("Row %s clashes with a row already selected" % row)
+            self.cover(self.C[j])
+            j = self.R[j]
+            if j == first:
+                break
+
+    def search(self, limit):
+        ''' Returns up to $limit solutions, each a list of row numbers.'''
+        solutions = []
+        self._search([], solutions, limit)
+        return solutions
+
+    def _search(self, partial, solutions, limit):
+        L, R, D, C, S = self.L, self.R, self.D, self.C, self.S
+        if R[0] == 0:
+            solutions.append(list(partial))
+            return
+        # Branch on the column with the fewest rows left.
+        best = c = R[0]
+        while c:
+            if S[c] < S[best]:
+                best = c
+                if not S[c]:
+                    return
+            c = R[c]
+
+        self.cover(best)
+        i = D[best]
+        while i != best:
+            partial.append(self.row_of[i])
+            j = R[i]
+            while j != i:
+                self.cover(C[j])
+                j = R[j]
+            self._search(partial, solutions, limit)
+            j = L[i]
+            while j != i:
+                self.uncover(C[j])
+                j = L[j]
+            partial.pop()
+            if len(solutions) >= limit:
+                break
+            i = D[i]
+        self.uncover(best)
+
+def exact_cover_columns(i, k, box_size=3):
+    '''
+    The four constraints satisfied by putting value k in cell i: the cell
+    is filled, and the value appears in its row, its column and its box.
+    '''
+    n = box_size
+    size = n * n
+    r, c = divmod(i, size)
+    box = (r // n) * n + c // n
+    area = size * size
+    return (1 + i, 1 + area + r * size + k, 1 + 2 * area + c * size + k, 1 + 3 * area + box * size + k)
+
+class SudokuDLX:
+    '''
+    Solves a board as an exact cover problem with DancingLinks. Row
+    i * size + k of the matrix means "cell i holds value k".
+    '''
+    def __init__(self, givens, box_size=3):
+        ''' $givens maps cell indexes to the index in the symbols of their value.'''
+        self.geometry = g = geometry(box_size)
+        self.givens = givens
+        self.solution = None
+        self.links = DancingLinks(4 * g.n_cells, [exact_cover_columns(i, k, box_size)
+                                                  for i in range(g.n_cells) for k in range(g.size)])
+        for i, k in sorted(givens.items()):
+            self.links.select(i * g.size + k)
+
+    @classmethod
+    def init_from_text(cls, processed_text, box_size=3):
+        g = geometry(box_size)
+        assert len(processed_text) == g.n_cells
+        return cls({i: g.symbols.index(char) for i, char in enumerate(processed_text) if char not in '.0'},
+                   box_size)
+
+    def values(self):
+        ''' The board as a list of strings of possible values, one per cell.'''
+        g = self.geometry
+        solved = dict(self.givens)
+        if self.solution:
+            solved.update(divmod(row, g.size) for row in self.solution)
+        values = []
+        for i in range(g.n_cells):
+            if i in solved:
+                values.append(g.symbols[solved[i]])
+            else:
+                # The rows still linked into the cell's column.
+                links = self.links
+                n, possible = links.D[1 + i], ''
+                while n != 1 + i:
+                    possible += g.symbols[links.row_of[n] % g.size]
+                    n = links.D[n]
+                values.append(possible)
+        return values
+
+    def __str__(self):
+        return format_grid(self.values(), self.geometry.box_size)
+
+    def is_solved(self):
+        return self.solution is not None or len(self.givens) == self.geometry.n_cells
+
+    def count_solutions(self, limit=2):
+        ''' Counts solutions, stopping as soon as $limit have been found.'''
+        return len(self.links.search(limit))
+
+    def full_solve(self):
+        '''
+        Raises InvalidBoardState if there is no solution and MultipleSolutions
+        as soon as a second one is found; otherwise records the solution.
+        '''
+        solutions = self.links.search(2)
+        if not solutions:
+            raise InvalidBoardState("Uhoh - we bruteforced and found that no possibilities worked!")
+        elif len(solutions) > 1:
+            boards = []
+            for solution in solutions:
+                self.solution = solution
+                boards.append(str(self))
+            self.solution = None
+            raise MultipleSolutions('\n'.join(boards))
+        self.solution = solutions[0]
+
+def random_solution(box_size=3, rng=random):
+    ''' A random full grid, as one character per cell.'''
+    board = SudokuBitBoard.init_from_text('.' * geometry(box_size).n_cells, box_size)
+    solutions = []
+    board._search(solutions, 1, rng)
+    return SudokuBitBoard(solutions[0], box_size).to_text()
+
+def has_other_solution(puzzle, solution, cells, box_size=3, max_guesses=None):
+    '''
+    Given that $puzzle plus the clues from $solution at $cells had only
+    the one solution, checks whether $puzzle by itself has another.
+    Any other solution would have to break one of those clues, so this
+    searches for a single solution with each of those cells made to
+    differ, which propagation usually refutes straight away.
+
+    A search that takes more than $max_guesses guesses is abandoned and
+    counts as finding another solution, since none was ruled out.
+    '''
+    g = geometry(box_size)
+    for i in cells:
+        board = LimitedSudokuBitBoard.init_from_text(puzzle, box_size, max_guesses=max_guesses)
+        found = []
+        try:
+            board.simplify()
+            board.eliminate(i, 1 << g.symbols.index(solution[i]))
+            board._search(found, 1)
+        except InvalidBoardState:
+            pass
+        except GuessLimitReached:
+            return True
+        if found:
+            return True
+    return False
+
+Rating = namedtuple('Rating', ['difficulty', 'call_count', 'guess_count'])
+
+def rate(puzzle, box_size=3):
+    '''
+    Rates a puzzle by the work SudokuBitBoard needs to solve it: call_count
+    counts eliminations and guess_count counts guessed assignments,
+    including the ones spent ruling out a second solution.
+    '''
+    board = InstrumentedSudokuBitBoard.init_from_text(puzzle, box_size)
+    board.simplify()
+    if board.is_solved():
+        difficulty = 'easy'
+    else:
+        board.full_solve()
+        if board.stats.guesses <= 10:
+            difficulty = 'medium'
+        elif board.stats.guesses <= 100:
+            difficulty = 'hard'
+        else:
+            difficulty = 'fiendish'
+    return Rating(difficulty, board.stats.eliminations, board.stats.guesses)
+
+# Proving that a dug-out 16x16 or 25x25 puzzle is still unique can take
+# thousands of guesses, or far more; on 9x9 boards no probe was seen to
+# need more than about 100. generate keeps a clue rather than go past this.
+GENERATE_MAX_GUESSES = 200
+
+def generate(box_size=3, rng=random, min_clues=0):
+    '''
+    Generates a puzzle with a unique solution. Starting from a random full
+    grid, clues are dug out in symmetric pairs (a cell and its 180 degree
+    rotation) in random order, keeping each removal only if the solution
+    stays unique. Stops early rather than go below $min_clues clues, and
+    keeps any pair whose removal takes more than GENERATE_MAX_GUESSES
+    guesses to check.
+
+    Returns (puzzle, solution, Rating).
+    '''
+    solution = random_solution(box_size, rng)
+    n_cells = len(solution)
+    puzzle = list(solution)
+    clues = n_cells
+    pairs = sorted(set((min(i, n_cells - 1 - i), max(i, n_cells - 1 - i)) for i in range(n_cells)))
+    rng.shuffle(pairs)
+    for pair in pairs:
+        removed = set(pair)
+        if clues - len(removed) < min_clues:
+            continue
+        for i in removed:
+            puzzle[i] = '.'
+        if has_other_solution(''.join(puzzle), solution, removed, box_size, GENERATE_MAX_GUESSES):
+            for i in removed:
+                puzzle[i] = solution[i]
+        else:
+            clues -= len(removed)
+    puzzle = ''.join(puzzle)
+    return puzzle, solution, rate(puzzle, box_size)
+
+def _generate_job(job):
+    box_size, seed = job
+    return generate(box_size, random.Random(seed))
+
+# SudokuBitBoard solves most puzzles about twice as fast as SudokuDLX, but
+# can take minutes to find a second solution to a badly underconstrained
+# puzzle, which DLX settles in milliseconds. solve_text switches over to DLX
+# after this many guesses.
+BATCH_MAX_GUESSES = 1000
+
+def solve_text(processed_text, box_size=3, stats=None):
+    '''
+    Solves a puzzle given as one character per cell and returns the
+    solution in the same form, or 'INVALID' / 'MULTIPLE' if it has no
+    unique solution. Given a SolveStats as $stats, records the work done
+    into it; time spent handing the puzzle over to SudokuDLX is counted
+    under 'dlx'.
+    '''
+    if len(processed_text) != geometry(box_size).n_cells:
+        return 'INVALID'
+    if stats is None:
+        board = LimitedSudokuBitBoard.init_from_text(processed_text, box_size, max_guesses=BATCH_MAX_GUESSES)
+    else:
+        board = InstrumentedSudokuBitBoard.init_from_text(processed_text, box_size,
+                                                          max_guesses=BATCH_MAX_GUESSES, stats=stats)
+    try:
+        board.simplify()
+        try:
+            board.full_solve()
+        except GuessLimitReached:
+            start = time.time()
+            board = SudokuDLX.init_from_text(processed_text, box_size)
+            try:
+                board.full_solve()
+            finally:
+                if stats is not None:
+                    stats.add_time('dlx', time.time() - start)
+            return ''.join(board.values())
+    except InvalidBoardState:
+        return 'INVALID'
+    except MultipleSolutions:
+        return 'MULTIPLE'
+    return board.to_text()
+
+def _solve_job(job):
+    processed_text, box_size, with_stats = job
+    if not with_stats:
+        return solve_text(processed_text, box_size)
+    stats = SolveStats()
+    return solve_text(processed_text, box_size, stats), stats
+
+def solve_many(lines, box_size=3, processes=None, chunksize=64, stats=False):
+    '''
+    Solves one puzzle per line of $lines on a pool of $processes workers
+    (default: one per core) and yields solve_text's result for each, in
+    input order. Lines without any digits or dots are skipped. With
+    $stats, yields (result, SolveStats) pairs instead.
+
+    Lines are pulled lazily and only a bounded number of puzzles are in
+    flight at once, so arbitrarily long inputs stream through.
+    '''
+    puzzles = (process_rawtext(line, box_size) for line in lines)
+    jobs = ((puzzle, box_size, stats) for puzzle in puzzles if puzzle)
+    return parallel.imap_bounded(_solve_job, jobs, processes, chunksize)
 
 if __name__ == '__main__':
+    import argparse
     import sys
-    for line in sys.stdin.readlines():
-        sudoku = SudokuBoard.init_from_text(process_rawtext(line))
-        sudoku.simplify()
-        print(sudoku)
-        if not sudoku.is_solved():
-            print("Simplifying wasn't enough; attempting DFS bruteforce")
-            sudoku.full_solve(debug=True)
-            print(sudoku)
 
+    parser = argparse.ArgumentParser(description='Solves sudoku puzzles, one per line of input.')
+    parser.add_argument('--batch', metavar='FILE', nargs='?', const='-',
+                        help='Solve puzzles from FILE (default: stdin) in parallel, printing one solved '
+                             'grid per line (or INVALID / MULTIPLE) in input order.')
+    parser.add_argument('--generate', metavar='COUNT', type=int, default=None,
+                        help='Generate COUNT puzzles with unique solutions, printing each with its difficulty, '
+                             'number of eliminations and number of guesses')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for --generate')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='Worker processes for --batch and --generate (default: one per core)')
+    parser.add_argument('--box-size', type=int, default=3,
+                        help='Solve or generate boards of BOX_SIZE**2 x BOX_SIZE**2 cells with --batch or '
+                             '--generate, e.g. 4 for 16x16. Values are written %s. Generating takes seconds '
+                             'per 16x16 puzzle and about half a minute per 25x25 one.'
+                             % ', '.join(geometry(n).symbols for n in (3, 4, 5)))
+    parser.add_argument('--debug', action='store_true', help='Trace every step when not in --batch mode')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print assignment, elimination, guess and timing statistics; with --batch, '
+                             'the totals over all puzzles are printed to stderr')
+    parser.add_argument('--rule', dest='rules', action='append', default=[], choices=sorted(RULES),
+                        help='Apply an extra deduction before guessing when not in --batch mode (repeatable)')
+    args = parser.parse_args()
+    if args.box_size < 2 or args.box_size ** 2 > len(SYMBOLS):
+        parser.error('--box-size must be from 2 to 5')
+
+    if args.generate is not None:
+        seed = random.randrange(2**32) if args.seed is None else args.seed
+        start = time.time()
+        jobs = ((args.box_size, seed + k) for k in range(args.generate))
+        for puzzle, solution, rating in parallel.imap_bounded(_generate_job, jobs, args.processes, 4):
+            print(puzzle, rating.difficulty, rating.call_count, rating.guess_count)
+        elapsed = time.time() - start
+        sys.stderr.write('Generated %s puzzles in %.2fs (%.0f puzzles/minute)\n'
+                         % (args.generate, elapsed, 60 * args.generate / elapsed if elapsed else 0))
+    elif args.batch is None:
+        for line in sys.stdin:
+            if args.debug or args.stats:
+                sudoku = InstrumentedSudokuBoard.init_from_text(process_rawtext(line), rules=args.rules,
+                                                                listener=print_event if args.debug else None)
+            else:
+                sudoku = SudokuBoard.init_from_text(process_rawtext(line), rules=args.rules)
+            sudoku.simplify()
+            print(sudoku)
+            if not sudoku.is_solved():
+                print("Simplifying wasn't enough; attempting DFS bruteforce")
+                sudoku.full_solve()
+                print(sudoku)
+            if args.stats:
+                print(sudoku.stats)
+    else:
+        source = sys.stdin if args.batch == '-' else open(args.batch)
+        start = time.time()
+        count = 0
+        totals = SolveStats()
+        for result in solve_many(source, args.box_size, args.processes, stats=args.stats):
+            if args.stats:
+                result, stats = result
+                totals.add(stats)
+            count += 1
+            print(result)
+        elapsed = time.time() - start
+        sys.stderr.write('Solved %s puzzles in %.2fs (%.0f puzzles/s)\n'
+                         % (count, elapsed, count / elapsed if elapsed else 0))
+        if args.stats:
+            sys.stderr.write('%s\n' % totals)
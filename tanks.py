@@ -1,7 +1,11 @@
 from __future__ import print_function
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import math
 from copy import deepcopy
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 MAP_WIDTH = 40
 MAP_HEIGHT = 20
@@ -58,28 +62,106 @@ def refresh_view(board, player1, player2, projectile_path=None):
         print(hstrip)
     print('Player 1 HP: %s     Player 2 HP: %s' % (player1.hp, player2.hp))
 
+# A projectile follows the parabola
+#   x(t) = x0 + v_x t,  y(t) = y0 + v_y t + GRAVITY t^2 / 2
+# until it first goes below the top of the column it is over, or leaves the
+# map to the left or right. The terrain is flat across each column, so the
+# parabola is checked one column at a time: it either runs into the side
+# of the next column, or comes down through the top of the column it's
+# over, where y(t) is the column's height.
+
+def launch(projectile):
+    ''' The starting position and velocity (x0, y0, v_x, v_y) of a projectile.'''
+    return (projectile.x, projectile.y,
+            projectile.power * math.cos(projectile.angle),
+            projectile.power * math.sin(projectile.angle))
+
+def position_at(projectile, t):
+    x0, y0, v_x, v_y = launch(projectile)
+    return Point(x0 + v_x * t, y0 + v_y * t + GRAVITY * t * t / 2.0)
+
+def impact_time(projectile, board):
+    '''
+    When the projectile first hits the terrain or leaves the map, and the
+    column it hit (-1 or MAP_WIDTH if it left the map).
+    '''
+    x0, y0, v_x, v_y = launch(projectile)
+    if not 0 < x0 < MAP_WIDTH:
+        return 0.0, int(x0)
+    a = GRAVITY / 2.0
+    if v_x > 0:
+        column, step = int(math.floor(x0)), 1
+    elif v_x < 0:
+        column, step = int(math.ceil(x0)) - 1, -1
+    else:
+        column, step = int(x0), 0
+    t_in = 0.0
+    while 0 <= column < MAP_WIDTH:
+        height = board[column]
+        if y0 + v_y * t_in + a * t_in * t_in < height:
+            # Ran into the side of this column.
+            return t_in, column
+        # The later time that y(t) == height, when the projectile comes back down.
+        discriminant = max(v_y * v_y - 4 * a * (y0 - height), 0.0)
+        t_down = max((-v_y - math.sqrt(discriminant)) / (2 * a), t_in)
+        if not step:
+            return t_down, column
+        t_out = (column + (step > 0) - x0) / v_x
+        if t_down < t_out:
+            return t_down, column
+        t_in = t_out
+        column += step
+    # Left the map.
+    return t_in, column
+
+# Keeps x inside the column that was hit, so that int(x) is that column.
+# A shell flying left hits a wall exactly on the wall's right edge.
+_JUST_INSIDE = 1 - 1e-9
+
+def _impact_position(projectile, t, column):
+    x, y = position_at(projectile, t)
+    if 0 <= column < MAP_WIDTH:
+        x = min(max(x, column), column + _JUST_INSIDE)
+    return x, y
+
+def path_points(projectile, t_end):
+    '''
+    The set of Points, rounded to whole pixels, that the projectile passes
+    through before $t_end. Over each pixel column, y runs continuously
+    between its extremes, so every pixel in between is on the path.
+    '''
+    x0, y0, v_x, v_y = launch(projectile)
+    def y_at(t):
+        return y0 + v_y * t + GRAVITY * t * t / 2.0
+    t_apex = -v_y / GRAVITY
+    x_end = x0 + v_x * t_end
+    path = set()
+    first, last = int(round(x0)), int(round(x_end))
+    for x in range(min(first, last), max(first, last) + 1):
+        # When the projectile is over the pixel column x.
+        if v_x:
+            t_a, t_b = sorted([(x - .5 - x0) / v_x, (x + .5 - x0) / v_x])
+            t_a, t_b = max(t_a, 0.0), min(t_b, t_end)
+        else:
+            t_a, t_b = 0.0, t_end
+        ys = [y_at(t_a), y_at(t_b)]
+        if t_a < t_apex < t_b:
+            ys.append(y_at(t_apex))
+        for y in range(int(round(min(ys))), int(round(max(ys))) + 1):
+            path.add(Point(x, y))
+    return path
+
+def impact_point(projectile, board):
+    return _impact_position(projectile, *impact_time(projectile, board))
+
 def compute_impact(projectile, board):
-    'Performs euler integration to determine projectile path and impact point.'
-    x = projectile.x
-    y = projectile.y
-    power = projectile.power
-    angle = projectile.angle
-    v_x = power * math.cos(angle)
-    v_y = power * math.sin(angle)
-    
-    # Using a set allows us to do a fine-grained simulation while
-    # only keeping unique points at the end.
-    projectile_path = set()
-
-    dt = .01
-    while 0 < x < MAP_WIDTH and y >= board[int(x)]:
-        x += dt * v_x
-        y += dt * v_y
-        v_y += dt * GRAVITY
-        projectile_path.add(Point(int(round(x)), int(round(y))))
-    
-    return (x, y), projectile_path
-    
+    '''
+    Works out where the projectile hits from its exact trajectory, and the
+    path it takes there.
+    '''
+    t, column = impact_time(projectile, board)
+    return _impact_position(projectile, t, column), path_points(projectile, t)
+
 def apply_explosion(impact_center, board):
     '''Returns a board with a circular explosion carved out. 
     Any land above the explosion is removed. '''
@@ -91,11 +173,160 @@ def apply_explosion(impact_center, board):
             board[x + i] = int(min(board[x + i], y - math.sqrt(EXPLOSION_RADIUS**2 - i **2)))
     return board
 
+# Computer players.
+#
+# ComputerPlayer aims by trying a whole grid of (angle, power) shots,
+# keeping the few that look best, and trying finer grids around those.
+# With NumPy, impact_points works out a batch of shots all at once,
+# stepping them across the columns together as impact_time does one.
+
+def impact_points(x0, y0, angles, powers, board):
+    '''
+    impact_point for a batch of shots fired from (x0, y0), as arrays of x
+    and y. Requires NumPy.
+    '''
+    angles, powers = np.broadcast_arrays(np.asarray(angles, dtype=float), np.asarray(powers, dtype=float))
+    v_x = powers * np.cos(angles)
+    v_y = powers * np.sin(angles)
+    a = GRAVITY / 2.0
+    heights = np.asarray(board, dtype=float)
+    step = np.sign(v_x).astype(int)
+    column = np.where(v_x > 0, int(math.floor(x0)), np.where(v_x < 0, int(math.ceil(x0)) - 1, int(x0)))
+    t_in = np.zeros(v_x.shape)
+    t_hit = np.zeros(v_x.shape)
+    active = np.ones(v_x.shape, dtype=bool) if 0 < x0 < MAP_WIDTH else np.zeros(v_x.shape, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        while active.any():
+            # Left the map.
+            outside = active & ((column < 0) | (column >= MAP_WIDTH))
+            t_hit[outside] = t_in[outside]
+            active &= ~outside
+            height = heights[np.clip(column, 0, MAP_WIDTH - 1)]
+            # Ran into the side of a column.
+            wall = active & (y0 + v_y * t_in + a * t_in * t_in < height)
+            t_hit[wall] = t_in[wall]
+            active &= ~wall
+            # Came down through the top of a column.
+            discriminant = np.maximum(v_y * v_y - 4 * a * (y0 - height), 0.0)
+            t_down = np.maximum((-v_y - np.sqrt(discriminant)) / (2 * a), t_in)
+            t_out = np.where(step != 0, (column + (step > 0) - x0) / v_x, np.inf)
+            down = active & (t_down < t_out)
+            t_hit[down] = t_down[down]
+            active &= ~down
+            t_in = np.where(active, t_out, t_in)
+            column = column + step * active
+    xs = x0 + v_x * t_hit
+    on_map = (column >= 0) & (column < MAP_WIDTH)
+    xs = np.where(on_map, np.minimum(np.maximum(xs, column), column + _JUST_INSIDE), xs)
+    return xs, y0 + v_y * t_hit + a * t_hit * t_hit
+
+def _damage(distance):
+    ''' Player.applyDamage, before rounding down.'''
+    return 20 * math.exp(-0.15 * distance)
+
+class ComputerPlayer(Player):
+    '''
+    A player that aims at $opponent by itself. A shot is judged by how
+    much damage it would do to the opponent, less the damage it would do
+    to this player, with the terrain as it is before the shot. The best
+    few shots after refining are judged again on the terrain as it would
+    be after the explosion.
+
+    Aims are cached by terrain and positions, keeping the last
+    $cache_size, so a turn that repeats an earlier one costs nothing.
+    '''
+    # Fire at every ANGLE_STEP degrees and POWER_STEP power to begin with,
+    # then keep the best KEEP shots and refine REFINE_ROUNDS times, halving
+    # the steps each time.
+    ANGLE_STEP, POWER_STEP = (1.0, 0.25) if np is not None else (5.0, 1.0)
+    MAX_POWER = 20
+    KEEP = 5
+    REFINE_ROUNDS = 4
+
+    def __init__(self, x_position, opponent=None, cache_size=256):
+        Player.__init__(self, x_position)
+        self.opponent = opponent
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def fireProjectile(self, board):
+        angle, power = self.aim(board)
+        print('Firing at angle %.1f with power %.2f' % (math.degrees(angle), power))
+        return Projectile(x=self.x, y=board[self.x], angle=angle, power=power)
+
+    def aim(self, board):
+        ''' The best (angle in radians, power) to fire at the opponent with.'''
+        key = (tuple(board), self.x, self.opponent.x)
+        if key in self.cache:
+            self.cache[key] = self.cache.pop(key)
+            return self.cache[key]
+        angles = [i * self.ANGLE_STEP for i in range(int(180 / self.ANGLE_STEP) + 1)]
+        powers = [(i + 1) * self.POWER_STEP for i in range(int(self.MAX_POWER / self.POWER_STEP))]
+        shots = self._best_shots(board, [(angle, power) for angle in angles for power in powers])
+        angle_step, power_step = self.ANGLE_STEP, self.POWER_STEP
+        for _ in range(self.REFINE_ROUNDS):
+            angle_step, power_step = angle_step / 2, power_step / 2
+            candidates = set(shots)
+            for angle, power in shots:
+                candidates.update((angle + i * angle_step, min(max(power + j * power_step, 0), self.MAX_POWER))
+                                  for i in (-1, 0, 1) for j in (-1, 0, 1))
+            shots = self._best_shots(board, sorted(candidates))
+        angle, power = max(shots, key=lambda shot: self._exact_score(board, shot))
+        aim = (math.radians(angle), power)
+        self.cache[key] = aim
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return aim
+
+    def _best_shots(self, board, shots):
+        ''' The KEEP best of $shots, given as (angle in degrees, power).'''
+        x0, y0 = self.x, board[self.x]
+        targets = [(self.opponent.x, board[self.opponent.x], 1), (self.x, board[self.x], -1)]
+        if np is not None:
+            angles, powers = np.array(shots).T
+            xs, ys = impact_points(x0, y0, np.radians(angles), powers, board)
+            scores = sum(sign * 20 * np.exp(-0.15 * np.hypot(xs - x, ys - y)) for x, y, sign in targets)
+            best = np.argsort(-scores, kind='mergesort')[:self.KEEP]
+        else:
+            scores = []
+            for angle, power in shots:
+                x, y = impact_point(Projectile(x0, y0, math.radians(angle), power), board)
+                scores.append(sum(sign * _damage(math.hypot(x - tx, y - ty)) for tx, ty, sign in targets))
+            best = sorted(range(len(shots)), key=lambda i: -scores[i])[:self.KEEP]
+        return [shots[i] for i in best]
+
+    def _exact_score(self, board, shot):
+        ''' Damage to the opponent less damage to self, as the game would deal it.'''
+        angle, power = shot
+        impact = impact_point(Projectile(self.x, board[self.x], math.radians(angle), power), board)
+        after = apply_explosion(impact, board)
+        return sum(sign * int(_damage(math.hypot(player.x - impact[0], after[player.x] - impact[1])))
+                   for player, sign in ((self.opponent, 1), (self, -1)))
+
+_testboard = [7] * MAP_WIDTH
+_testboard[19] = 11
+# Fired left from column 25, into the side of column 19.
+_testimpact = impact_point(Projectile(x=25, y=7, angle=math.radians(170), power=10), _testboard)
+assert int(_testimpact[0]) == 19 and _testimpact[1] < 11
+assert apply_explosion(_testimpact, _testboard)[19] < 11
+
 player1 = Player(int(MAP_WIDTH*.1))
 player2 = Player(int(MAP_WIDTH*.9))
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Two tanks take turns firing at each other.')
+    parser.add_argument('--computer', choices=['1', '2', 'both'], default=None,
+                        help='Let the computer play player 1, player 2 or both')
+    args = parser.parse_args()
+    if args.computer in ('1', 'both'):
+        player1 = ComputerPlayer(player1.x)
+    if args.computer in ('2', 'both'):
+        player2 = ComputerPlayer(player2.x)
+    for player, opponent in ((player1, player2), (player2, player1)):
+        player.opponent = opponent
+
     board = [int(MAP_HEIGHT / 2)] * MAP_WIDTH
     player1turn = True
     refresh_view(board, player1, player2)
@@ -0,0 +1,188 @@
+from __future__ import print_function
+import mmap
+import os
+import struct
+import sys
+
+# A compact, memory-mapped word index shared by the word games.
+#
+# The word list is compiled once into a DAWG (a trie whose identical
+# subtrees have been merged) and written to disk as flat arrays. Loading
+# the index just maps the file into memory, so a cold import costs next to
+# nothing and every process using the index shares the same pages through
+# the OS page cache.
+#
+# A node is addressed by an integer; the root is node 0. File layout, all
+# integers little-endian uint32:
+#
+#   header  'WIDX', version, node count, edge count, word count, max length
+#   nodes   node count + 1 entries. Entry i is the index of node i's first
+#           edge, with the top bit set if node i completes a word. Node i's
+#           edges run up to entry i+1.
+#   targets edge count entries, the node each edge leads to
+#   labels  edge count bytes, the letter on each edge, sorted within a node
+
+WORDS_PATH = '/usr/share/dict/words'
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'words.dawg')
+
+MAGIC = b'WIDX'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIII')
+UINT = struct.Struct('<I')
+UINT_PAIR = struct.Struct('<II')
+TERMINAL = 1 << 31
+
+if sys.version_info[0] < 3:
+    def _encode(text):
+        return text
+    def _decode(data):
+        return data
+else:
+    def _encode(text):
+        return text.encode('utf-8')
+    def _decode(data):
+        return data.decode('utf-8')
+
+def read_words(path=WORDS_PATH):
+    ''' Reads a word list, one word per line, upper-cased as bytes.'''
+    with open(path, 'rb') as f:
+        return set(line.strip().upper() for line in f)
+
+def build(words, path=INDEX_PATH):
+    '''
+    Compiles an iterable of words into a DAWG and writes it to $path.
+    The file is written under a temporary name and renamed into place, so
+    processes that are loading the index never see a half-written file.
+    '''
+    words = set(_encode(w) if not isinstance(w, bytes) else w for w in words)
+    words.discard(b'')
+    END = None
+
+    trie = {}
+    for word in words:
+        node = trie
+        for i in range(len(word)):
+            node = node.setdefault(word[i:i+1], {})
+        node[END] = True
+
+    # Merge identical subtrees bottom-up. A subtree is identified by whether
+    # it completes a word plus its (label, child id) edges.
+    registry = {}
+    nodes = []
+    def freeze(node):
+        edges = tuple((label, freeze(child)) for label, child in sorted(
+                        (k, v) for k, v in node.items() if k is not END))
+        key = (END in node, edges)
+        if key not in registry:
+            registry[key] = len(nodes)
+            nodes.append(key)
+        return registry[key]
+    freeze(trie)
+
+    # Children were frozen before their parents, so the root came last.
+    # Renumber backwards to make it node 0.
+    last = len(nodes) - 1
+    first_edges = []
+    targets = []
+    labels = []
+    for is_word, edges in reversed(nodes):
+        first_edges.append(len(targets) | (TERMINAL if is_word else 0))
+        for label, child in edges:
+            labels.append(label)
+            targets.append(last - child)
+    first_edges.append(len(targets))
+
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(nodes), len(targets),
+                            len(words), max([len(w) for w in words] or [0])))
+        f.write(struct.pack('<%sI' % len(first_edges), *first_edges))
+        f.write(struct.pack('<%sI' % len(targets), *targets))
+        f.write(b''.join(labels))
+    os.rename(tmp_path, path)
+
+class WordIndex():
+    '''
+    A read-only view of a compiled index. Supports `word in index`, len(),
+    iteration in sorted order, and walking the DAWG node by node for prefix
+    searches.
+    '''
+    def __init__(self, path=INDEX_PATH):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.node_count, edge_count, self.word_count, self.max_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a version %s word index' % (path, VERSION))
+        self._nodes = HEADER.size
+        self._targets = self._nodes + 4 * (self.node_count + 1)
+        self._labels = self._targets + 4 * edge_count
+
+    def __len__(self):
+        return self.word_count
+
+    def __contains__(self, word):
+        node = self.walk(0, word)
+        return node is not None and self.is_word(node)
+
+    def __iter__(self):
+        stack = [(0, b'')]
+        while stack:
+            node, prefix = stack.pop()
+            if self.is_word(node):
+                yield _decode(prefix)
+            start, end = self._edges(node)
+            for edge in range(end - 1, start - 1, -1):
+                label = self._map[self._labels + edge:self._labels + edge + 1]
+                stack.append((UINT.unpack_from(self._map, self._targets + 4 * edge)[0], prefix + label))
+
+    def _edges(self, node):
+        start, end = UINT_PAIR.unpack_from(self._map, self._nodes + 4 * node)
+        return start & ~TERMINAL, end & ~TERMINAL
+
+    def is_word(self, node):
+        return UINT.unpack_from(self._map, self._nodes + 4 * node)[0] >= TERMINAL
+
+    def child(self, node, letter):
+        '''
+        The node reached by following a single-letter edge from $node,
+        or None if no word continues that way.
+        '''
+        start, end = self._edges(node)
+        edge = self._map.find(_encode(letter), self._labels + start, self._labels + end)
+        if edge < 0:
+            return None
+        return UINT.unpack_from(self._map, self._targets + 4 * (edge - self._labels))[0]
+
+    def walk(self, node, text):
+        ''' Follows each letter of $text from $node. Returns None on a dead end.'''
+        for letter in text:
+            node = self.child(node, letter)
+            if node is None:
+                return None
+        return node
+
+    def has_prefix(self, prefix):
+        return self.walk(0, prefix) is not None
+
+_LOADED = {}
+
+def load(path=INDEX_PATH, words_path=WORDS_PATH):
+    '''
+    Maps the index at $path, compiling it from $words_path first if it is
+    missing or older than the word list. Repeated loads share one mapping.
+    '''
+    if path not in _LOADED:
+        if (not os.path.exists(path)
+                or os.path.getmtime(path) < os.path.getmtime(words_path)):
+            build(read_words(words_path), path)
+        _LOADED[path] = WordIndex(path)
+    return _LOADED[path]
+
+if __name__ == '__main__':
+    # Build step: python wordindex.py [word list] [index file]
+    words_path = sys.argv[1] if len(sys.argv) > 1 else WORDS_PATH
+    path = sys.argv[2] if len(sys.argv) > 2 else INDEX_PATH
+    build(read_words(words_path), path)
+    index = WordIndex(path)
+    print('Wrote %s words in %s nodes to %s (%s bytes)'
+          % (len(index), index.node_count, path, os.path.getsize(path)))
@@ -1,7 +1,16 @@
 # Solves a word search puzzle with build-in word dictionary.
+from array import array
+import mmap
+import os
+import struct
+import wordindex
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-with open('/usr/share/dict/words') as f:
-    WORDS = set(line.strip().upper() for line in f.readlines())
+# Compiled once from /usr/share/dict/words; see wordindex.py
+WORDS = wordindex.load()
 
 def flip_horizontal(puzzle):
     return [row[::-1] for row in puzzle]
@@ -15,99 +24,308 @@ def flip_diagonal(puzzle):
 def rotate_180(puzzle):
     return flip_vertical(flip_horizontal(puzzle))
 
-# Straights
-def generate_horizontal(puzzle, min_length):
-    len_row = len(puzzle[0])
-    return [row[i:j] for row in puzzle
-                     for i in range(len_row)
-                     for j in range(len_row)
-                     if (i < j and j - i >= min_length)]
-
-def generate_vertical(puzzle, min_length):
-    return generate_horizontal(flip_diagonal(puzzle), min_length)
-
-def generate_horizontal_backwards(puzzle, min_length):
-    return generate_horizontal(flip_horizontal(puzzle), min_length)
-
-def generate_vertical_backwards(puzzle, min_length):
-    return generate_vertical(flip_vertical(puzzle), min_length)
-
-# Diagonals
-def generate_down_right_diagonals(puzzle, min_length):
-    def cycle(string, n):
-        return string[n:] + string[:n]
-    def realign_puzzle(puzzle):
-        return [cycle(row, i) for i, row in enumerate(puzzle)]
-    
-    transformed = flip_diagonal(realign_puzzle(puzzle))
-
-    # now we can just generate horizontal strings, while being
-    # careful to exclude strings that would have crossed boundaries
-    # in the original untransformed puzzle.
-
-    # ######
-    # %X*XX%
-    # %XX*X%
-    # %XXX*%
-    # %XXXX%
-    # ######
-
-    # gets transformed to
-
-    # #XXXX#
-    # #***%#
-    # #XX%%#
-    # #X%%X#
-    # #%%XX#
-    # #%XXX#
-
-    # Draw a diagonal from bottom left to top right. Any elements on this
-    # diagonal or above it are in sector A. Any elements below it are sector B.
-    # A horizontal word that stays entirely in one sector is a valid word in
-    # the untransformed puzzle.
-    len_row = len(puzzle[0])
-    def sector(location):
-        return location[0] + location[1] < len_row
-
-    def XNOR(sector1, sector2):
-        return (sector1 and sector2) or (not sector1 and not sector2)
-
-    return [row[c1:c2] for k, row in enumerate(transformed)
-                 for c1 in range(len_row)
-                 for c2 in range(len_row)
-                 if (c1 < c2 
-                    and c2 - c1 >= min_length
-                    and (XNOR(sector([c1,k]), sector([c2-1, k]))))]
-
-def generate_down_left_diagonals(puzzle, min_length):
-    return generate_down_right_diagonals(flip_horizontal(puzzle), min_length)
-
-def generate_up_right_diagonals(puzzle, min_length):
-    return generate_down_right_diagonals(flip_vertical(puzzle), min_length)
-
-def generate_up_left_diagonals(puzzle, min_length):
-    return generate_down_right_diagonals(rotate_180(puzzle), min_length)
+# The Aho-Corasick automaton for WORDS is compiled once and kept next to
+# the word index, in the same way: flat arrays that are memory-mapped, so
+# every process scanning puzzles shares one copy through the page cache.
+# All integers are little-endian uint32:
+#
+#   header  'WAHO', version, state count, longest word
+#   states  state count records of (first edge, end edge, fail, report,
+#           next report, length), described in AhoCorasick
+#   labels  one byte per edge, the letter on each edge, sorted within a
+#           state
+#
+# States are numbered breadth first, so edge i always leads to state i + 1
+# and the edges need no table of targets.
+
+AUTOMATON_PATH = os.path.join(os.path.dirname(wordindex.INDEX_PATH), 'words.aho')
+
+AUTOMATON_MAGIC = b'WAHO'
+AUTOMATON_VERSION = 1
+AUTOMATON_HEADER = struct.Struct('<4sIII')
+AUTOMATON_STATE = struct.Struct('<IIIIII')
+
+def build_automaton(words, path=AUTOMATON_PATH):
+    '''
+    Compiles an iterable of words into an Aho-Corasick automaton and writes
+    it to $path. Like wordindex.build, the file is written under a temporary
+    name and renamed into place.
+    '''
+    # Transitions live in a single dict keyed by (state << 8 | ord(letter)),
+    # which is much smaller than a dict per state.
+    goto = {}
+    lengths = array('i', [0])
+    parents = array('i', [0])
+    letters = array('i', [0])
+    depths = array('i', [0])
+    for word in words:
+        state = 0
+        for letter in word:
+            key = state << 8 | ord(letter)
+            child = goto.get(key)
+            if child is None:
+                child = goto[key] = len(lengths)
+                lengths.append(0)
+                parents.append(state)
+                letters.append(ord(letter))
+                depths.append(depths[state] + 1)
+            state = child
+        lengths[state] = len(word)
+
+    # Fail links, shallowest states first so parents are always done.
+    fail = array('i', [0]) * len(lengths)
+    report = array('i', [0]) * len(lengths)
+    for state in sorted(range(1, len(lengths)), key=depths.__getitem__):
+        parent = parents[state]
+        if parent:
+            f = fail[parent]
+            code = letters[state]
+            while f and (f << 8 | code) not in goto:
+                f = fail[f]
+            fail[state] = goto.get(f << 8 | code, 0)
+        report[state] = state if lengths[state] else report[fail[state]]
+    del goto
+
+    # Renumber breadth first, taking each state's children in letter order.
+    children = sorted(range(1, len(lengths)), key=lambda state: (parents[state], letters[state]))
+    first_child = array('i', [0]) * (len(lengths) + 1)
+    for state in children:
+        first_child[parents[state] + 1] += 1
+    for state in range(len(lengths)):
+        first_child[state + 1] += first_child[state]
+    order = [0]
+    for state in order:
+        order.extend(children[first_child[state]:first_child[state + 1]])
+    renumbered = array('i', [0]) * len(lengths)
+    for new, state in enumerate(order):
+        renumbered[state] = new
+
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(AUTOMATON_HEADER.pack(AUTOMATON_MAGIC, AUTOMATON_VERSION, len(order), max(lengths)))
+        edge = 0
+        for state in order:
+            start, edge = edge, edge + first_child[state + 1] - first_child[state]
+            f.write(AUTOMATON_STATE.pack(start, edge, renumbered[fail[state]], renumbered[report[state]],
+                               renumbered[report[fail[state]]], lengths[state]))
+        f.write(b''.join(chr(letters[state]) for state in order[1:]))
+    os.rename(tmp_path, path)
+
+class AhoCorasick():
+    '''
+    A read-only view of a compiled Aho-Corasick automaton: reports every
+    occurrence of every word in a text in one left-to-right pass, instead of
+    testing each substring.
+
+    States are numbered with the root as 0. A state's record holds the range
+    of its edges, its fail link (the state for its longest proper suffix
+    that is also in the trie), its report link (the nearest state along the
+    fail chain, itself included, that ends a word), the report link of its
+    fail state, and the length of the word ending there (0 if none).
+    '''
+    def __init__(self, path=AUTOMATON_PATH):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.state_count, self.max_length = AUTOMATON_HEADER.unpack_from(self._map, 0)
+        if magic != AUTOMATON_MAGIC or version != AUTOMATON_VERSION:
+            raise ValueError('%s is not a version %s automaton' % (path, AUTOMATON_VERSION))
+        self._states = AUTOMATON_HEADER.size
+        self._labels = self._states + AUTOMATON_STATE.size * self.state_count
+
+    def scan(self, text, min_length=1):
+        '''
+        Yields (start, length) for every word of at least $min_length
+        letters occurring in $text.
+        '''
+        contents, states, labels, size = self._map, self._states, self._labels, AUTOMATON_STATE.size
+        record = AUTOMATON_STATE.unpack_from
+        state = 0
+        first, last, fail, report, _, _ = record(contents, states)
+        for end, letter in enumerate(text, 1):
+            while True:
+                edge = contents.find(letter, labels + first, labels + last)
+                if edge >= 0:
+                    state = edge - labels + 1
+                    first, last, fail, report, _, _ = record(contents, states + size * state)
+                    break
+                if not state:
+                    break
+                state = fail
+                first, last, fail, report, _, _ = record(contents, states + size * state)
+            # Words along the report chain get shorter, so stop at the
+            # first one that is too short.
+            found = report
+            while found:
+                found, length = record(contents, states + size * found)[4:]
+                if length < min_length:
+                    break
+                yield end - length, length
+
+_AUTOMATON = None
+
+def automaton():
+    '''
+    The Aho-Corasick automaton for WORDS. It is compiled to AUTOMATON_PATH
+    the first time it is needed, or when the word index is newer, which
+    takes several seconds and about 170MB, once. After that each
+    process just maps the file.
+    '''
+    global _AUTOMATON
+    if _AUTOMATON is None:
+        if (not os.path.exists(AUTOMATON_PATH)
+                or os.path.getmtime(AUTOMATON_PATH) < os.path.getmtime(wordindex.INDEX_PATH)):
+            build_automaton(WORDS)
+        _AUTOMATON = AhoCorasick()
+    return _AUTOMATON
+
+# Each direction is a (row, column) step.
+DIRECTIONS = {'E': (0, 1), 'W': (0, -1), 'S': (1, 0), 'N': (-1, 0),
+              'SE': (1, 1), 'NW': (-1, -1), 'SW': (1, -1), 'NE': (-1, 1)}
+
+def _python_lines(puzzle):
+    rows, cols = len(puzzle), len(puzzle[0])
+    def line(r, c, dr, dc):
+        letters = []
+        while 0 <= r < rows and 0 <= c < cols:
+            letters.append(puzzle[r][c])
+            r, c = r + dr, c + dc
+        return ''.join(letters)
+
+    across = [(r, 0, row) for r, row in enumerate(puzzle)]
+    down = [(0, c, column) for c, column in enumerate(flip_diagonal(puzzle))]
+    down_right = ([(r, 0, line(r, 0, 1, 1)) for r in range(rows)]
+                  + [(0, c, line(0, c, 1, 1)) for c in range(1, cols)])
+    down_left = ([(0, c, line(0, c, 1, -1)) for c in range(cols)]
+                 + [(r, cols - 1, line(r, cols - 1, 1, -1)) for r in range(1, rows)])
+    return across, down, down_right, down_left
+
+def _numpy_lines(puzzle):
+    rows, cols = len(puzzle), len(puzzle[0])
+    grid = np.frombuffer(''.join(puzzle), dtype=np.uint8).reshape(rows, cols)
+    # Mirroring the columns turns down-left diagonals into down-right ones.
+    mirrored = grid[:, ::-1]
+
+    across = [(r, 0, grid[r]) for r in range(rows)]
+    down = [(0, c, grid[:, c]) for c in range(cols)]
+    down_right = ([(r, 0, grid.diagonal(-r)) for r in range(rows)]
+                  + [(0, c, grid.diagonal(c)) for c in range(1, cols)])
+    down_left = ([(0, c, mirrored.diagonal(cols - 1 - c)) for c in range(cols)]
+                 + [(r, cols - 1, mirrored.diagonal(-r)) for r in range(1, rows)])
+    return across, down, down_right, down_left
+
+def directional_lines(puzzle, diagonals=True, reverse=True):
+    '''
+    Extracts every line of the puzzle that a word can lie along, once per
+    direction. Yields (direction, start row, start column, line), where
+    the line reads from the start cell in that direction to the edge.
+
+    With NumPy available the puzzle is held as one uint8 array, and every
+    row, column and diagonal is a strided view into it; reversed lines
+    are views too. Each line is only copied out as it is yielded.
+    '''
+    if np is not None:
+        across, down, down_right, down_left = _numpy_lines(puzzle)
+        text = lambda line: line.tobytes()
+    else:
+        across, down, down_right, down_left = _python_lines(puzzle)
+        text = lambda line: line
+
+    # Straights
+    for r, c, line in across:
+        yield 'E', r, c, text(line)
+    for r, c, line in down:
+        yield 'S', r, c, text(line)
+    if reverse:
+        for r, c, line in down:
+            yield 'N', r + len(line) - 1, c, text(line[::-1])
+        for r, c, line in across:
+            yield 'W', r, c + len(line) - 1, text(line[::-1])
+
+    # Diagonals, starting from the top and side edges
+    if diagonals:
+        for r, c, line in down_right:
+            yield 'SE', r, c, text(line)
+        for r, c, line in down_right:
+            yield 'NW', r + len(line) - 1, c + len(line) - 1, text(line[::-1])
+        for r, c, line in down_left:
+            yield 'NE', r + len(line) - 1, c - len(line) + 1, text(line[::-1])
+        for r, c, line in down_left:
+            yield 'SW', r, c, text(line)
 
 def is_valid_word(word):
     return word in WORDS
 
+def locate_words(puzzle, diagonals=True, reverse=True, min_length=4):
+    '''
+    Yields (word, start row, start column, direction) for every word in the
+    puzzle, during a single scan. Each word placement is reported once: a
+    palindrome read backwards over the same cells is not reported again.
+    '''
+    scan = automaton().scan
+    # Only palindromes can turn up twice, so only they need remembering.
+    seen_palindromes = set()
+    for direction, r, c, line in directional_lines(puzzle, diagonals, reverse):
+        dr, dc = DIRECTIONS[direction]
+        for start, length in scan(line, min_length):
+            word = line[start:start + length]
+            first = (r + start * dr, c + start * dc)
+            if word == word[::-1]:
+                last = (first[0] + (length - 1) * dr, first[1] + (length - 1) * dc)
+                placement = (word, min(first, last), max(first, last))
+                if placement in seen_palindromes:
+                    continue
+                seen_palindromes.add(placement)
+            yield word, first[0], first[1], direction
+
 def solve_crossword(puzzle, diagonals=True, reverse=True, min_length=4):
-    answers = []
-    answers.extend(filter(is_valid_word, generate_horizontal(puzzle, min_length)))
-    answers.extend(filter(is_valid_word, generate_vertical(puzzle, min_length)))
+    return [word for word, r, c, direction in locate_words(puzzle, diagonals, reverse, min_length)]
 
-    if reverse:
-        answers.extend(filter(is_valid_word, generate_vertical_backwards(puzzle, min_length)))
-        answers.extend(filter(is_valid_word, generate_horizontal_backwards(puzzle, min_length)))
-    if diagonals:
-        answers.extend(filter(is_valid_word, generate_down_right_diagonals(puzzle, min_length)))
-        answers.extend(filter(is_valid_word, generate_up_left_diagonals(puzzle, min_length)))
-        answers.extend(filter(is_valid_word, generate_up_right_diagonals(puzzle, min_length)))
-        answers.extend(filter(is_valid_word, generate_down_left_diagonals(puzzle, min_length)))
-    return answers
 
+def locate_words_in_file(path, diagonals=True, reverse=True, min_length=4, stripe_rows=256):
+    '''
+    Like locate_words, for a puzzle stored in a text file with one row per
+    line, all the same length. The file is memory-mapped and searched in
+    horizontal stripes of $stripe_rows rows, so memory use depends on the
+    stripe size and not on the size of the puzzle.
+
+    Each stripe is read together with enough of the following rows to hold
+    the longest word, and reports only the matches whose topmost cell lies
+    in its own rows. Every match is therefore reported by exactly one
+    stripe.
+    '''
+    overlap = automaton().max_length - 1
+    with open(path, 'rb') as f:
+        contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        width = contents.find(b'\n')
+        if width < 0:
+            width = len(contents)
+        newline = 1
+        if width > 0 and contents[width - 1:width] == b'\r':
+            width -= 1
+            newline = 2
+        stride = width + newline
+        # The last row may or may not have a trailing newline.
+        rows = (len(contents) + newline) // stride
+
+        for top in range(0, rows, stripe_rows):
+            bottom = min(rows, top + stripe_rows + overlap)
+            stripe = contents[top * stride:bottom * stride]
+            puzzle = [stripe[i * stride:i * stride + width] for i in range(bottom - top)]
+            for word, r, c, direction in locate_words(puzzle, diagonals, reverse, min_length):
+                last_r = r + (len(word) - 1) * DIRECTIONS[direction][0]
+                if min(r, last_r) < stripe_rows:
+                    yield word, top + r, c, direction
+    finally:
+        contents.close()
 
 if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        # python wordsearch.py PUZZLE_FILE
+        for word, r, c, direction in locate_words_in_file(sys.argv[1]):
+            print word, r, c, direction
+        sys.exit()
 
     puzzle = '''CDAPMDXC
 SJXXLHUK
@@ -118,4 +336,5 @@ JHDIEKGW
 FSEHQBZV
 SSENETUC'''.split()
 
-    print solve_crossword(puzzle, diagonals=True, reverse=True)
+    for word, r, c, direction in locate_words(puzzle, diagonals=True, reverse=True):
+        print '%s at row %s, column %s, going %s' % (word, r, c, direction)